@@ -4,25 +4,27 @@
 import urllib.request
 import tensorflow as tf
 import numpy as np
-from tqdm import tqdm
 import os
 import subprocess
-import zipfile
-import re
 
 import requests
-import zipfile
 import io
 
 import tensorflow as tf
-from tqdm import tqdm
 import numpy as np
 
 from keras.preprocessing.text import Tokenizer
-from tensorflow.keras.preprocessing.sequence import pad_sequences
 
-from numpy import array
 import time
+import threading
+from collections import Counter
+
+from Backbones import INCEPTION_V3_FEATURE_SHAPE, build_inception_v3, inception_v3_config, run_extraction
+from FeatureStore import ExtractionCache, ImageCache, benchmark_loading
+from ImagePreprocessing import ImageDecoder, benchmark_decode, to_uint8_tf
+from ImageSource import default_image_source
+from TFRecordShards import pack_shards
+from CaptionPreprocessing import CaptionCache, CaptionEncoder, CaptionIndex
 #-----------------------------------------------------------------
 #-----------------------------------------------------------------
 class BahdanauAttention(tf.keras.Model):
@@ -32,17 +34,29 @@ class BahdanauAttention(tf.keras.Model):
         self.W2 = tf.keras.layers.Dense(units)
         self.V = tf.keras.layers.Dense(1)
 
-    def call(self, features, hidden):
-        hidden_with_time_axis = tf.expand_dims(hidden, 1)
+    def precompute_keys(self, features):
+        # W1(features) does not depend on the decoder state, so it is computed
+        # once per image and reused for every timestep
+        # keys shape == (batch_size, 64, units)
+        return self.W1(features)
+
+    def call(self, features, hidden, keys=None):
+        if keys is None:
+            keys = self.precompute_keys(features)
+
+        # Dense layers only get rank-2 inputs here: on rank-3 inputs they run a
+        # tensordot, whose gradient XLA can't compile inside the decoding loop
+        hidden_with_time_axis = tf.expand_dims(self.W2(hidden), 1)
         # attention_hidden_layer shape == (batch_size, 64, units)
-        attention_hidden_layer = (tf.nn.tanh(self.W1(features) +
-                                                self.W2(hidden_with_time_axis)))
-        # score shape == (batch_size, 64, 1)
+        attention_hidden_layer = (tf.nn.tanh(keys +
+                                                hidden_with_time_axis))
+        # score shape == (batch_size, 64)
         # This gives you an unnormalized score for each image feature.
-        score = self.V(attention_hidden_layer)
+        units = attention_hidden_layer.shape[2]
+        score = tf.reshape(self.V(tf.reshape(attention_hidden_layer, (-1, units))), tf.shape(attention_hidden_layer)[:2])
 
         # attention_weights shape == (batch_size, 64, 1)
-        attention_weights = tf.nn.softmax(score, axis=1)
+        attention_weights = tf.expand_dims(tf.nn.softmax(score, axis=-1), -1)
 
         # context_vector shape after sum == (batch_size, hidden_size)
         context_vector = attention_weights * features
@@ -80,12 +94,18 @@ class RNN_Decoder(tf.keras.Model):
 
         self.attention = BahdanauAttention(self.units)
 
-    def call(self, x, features, hidden):
-        # defining attention as a separate model
-        context_vector, attention_weights = self.attention(features, hidden)
+    def attention_keys(self, features):
+        return self.attention.precompute_keys(features)
 
+    def call(self, x, features, hidden, keys=None):
         # x shape after passing through embedding == (batch_size, 1, embedding_dim)
-        x = self.embedding(x)
+        return self.step(self.embedding(x), features, hidden, keys)
+
+    def step(self, x, features, hidden, keys=None):
+        # Same as call, on an already embedded input, so the embeddings of a
+        # whole target sequence can be looked up at once
+        # defining attention as a separate model
+        context_vector, attention_weights = self.attention(features, hidden, keys=keys)
 
         # x shape after concatenation == (batch_size, 1, embedding_dim + hidden_size)
         x = tf.concat([tf.expand_dims(context_vector, 1), x], axis=-1)
@@ -93,11 +113,9 @@ class RNN_Decoder(tf.keras.Model):
         # passing the concatenated vector to the GRU
         output, state = self.gru(x)
 
-        # shape == (batch_size, max_length, hidden_size)
-        x = self.fc1(output)
-
-        # x shape == (batch_size * max_length, hidden_size)
-        x = tf.reshape(x, (-1, x.shape[2]))
+        # x shape == (batch_size * max_length, hidden_size), fc1 is given a
+        # rank-2 input, see BahdanauAttention.call
+        x = self.fc1(tf.reshape(output, (-1, output.shape[2])))
 
         # output shape == (batch_size * max_length, vocab)
         x = self.fc2(x)
@@ -111,205 +129,318 @@ class RNN_Decoder(tf.keras.Model):
 #-----------------------------------------------------------------
 
 class ImageCaptioning():
-    def __init__(self):
+    def __init__(self, jit_compile=False, feature_shape=(64, 2048), image_decoder=None, embedding_dim=256, units=512):
         self.tokenizer = Tokenizer()
         self.image_features_extract_model=None
+        self.feature_store=None
+        # Decoding and resizing of the images fed to InceptionV3
+        self.image_decoder = image_decoder or ImageDecoder((299, 299))
+        # Directory or zip file the image paths are read from, None for plain files
+        self.image_source = None
+        # Number of times each compiled function was traced
+        self.trace_counts = Counter()
+        # Bytes of image features loaded by the training pipeline, released by
+        # the training loop, and the most ever buffered in between
+        self.buffer_lock = threading.Lock()
+        self.loaded_bytes = 0
+        self.released_bytes = 0
+        self.peak_buffer_bytes = 0
+        # Whole feature store copied into host memory, when it fits the limit
+        self.host_features = None
+
+        # Batch size and caption length are left unknown in the signatures, so
+        # the short last batch or a new caption length reuse the same graph
+        # The whole teacher-forced step is one graph, optionally compiled with XLA
+        self.train_step = tf.function(self.teacher_forced_step, jit_compile=jit_compile,
+                                      input_signature=[tf.TensorSpec((None,) + tuple(feature_shape), tf.float32),
+                                                       tf.TensorSpec([None, None], tf.int32)])
+        # Same step on batches of images with all their captions
+        self.grouped_train_step = tf.function(self.grouped_teacher_forced_step, jit_compile=jit_compile,
+                                              input_signature=[tf.TensorSpec((None,) + tuple(feature_shape), tf.float32),
+                                                               tf.TensorSpec([None, None, None], tf.int32)])
+        # One decoder step for greedy, sampled and beam search decoding. The
+        # encoder output, hidden state and attention key sizes are fixed, so a
+        # decoder which was never called can still build its layers when traced
+        self.decode_step = tf.function(self.decoder_step,
+                                       input_signature=[tf.TensorSpec([None, 1], tf.int32),
+                                                        tf.TensorSpec([None, feature_shape[0], embedding_dim], tf.float32),
+                                                        tf.TensorSpec([None, units], tf.float32),
+                                                        tf.TensorSpec([None, feature_shape[0], units], tf.float32)])
 
             
-    def load_captions(self, zip_file_path,file_to_access):
-        # Extract the file from the zip file
-        with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-            with zip_ref.open(file_to_access) as file:
-                content = file.read()
-                
-                return(content)
-
-
-
-    def captions_dict (self, text):
-        dict = {}
-        ## Converting Bytes to string
-        text = text.decode('utf-8')
-        # Make a List of each line in the file
-        lines = text.split ('\n') 
-        for line in lines:
-            # Split into the <image_data> and <caption>
-            line_split = line.split ('\t')
-            if (len(line_split) != 2):
-                # Added this check because dataset contains some blank lines
-                continue
-            else:
-                image_data, caption = line_split
-            # Split into <image_file> and <caption_idx>
-            image_file, caption_idx = image_data.split ('#')
-            # Split the <image_file> into <image_name>.jpg
-            image_name = image_file.split ('.')[0]
-            # If this is the first caption for this image, create a new list for that
-            # image and add the caption to it. Otherwise append the caption to the 
-            # existing list
-            if (int(caption_idx) == 0):
-                dict [image_name] = [caption]
-            else:
-                dict [image_name].append (caption)
-        
-        return (dict)
-      
-    def subset_image_name (self, train_img_txt):
-        data = []
-        ## Converting Bytes to string
-        train_img_txt = train_img_txt.decode('utf-8')
-        # Make a List of each line in the file
-        lines = train_img_txt.split ('\n')
-        for line in lines:
-            # skip empty lines
-            if (len(line) < 1):
-                continue
-            # Each line is the <image_file>
-            # Split the <image_file> into <image_name>.jpg
-            image_name = line.split ('.')[0]
-            # Add the <image_name> to the list
-            data.append (image_name)
-
-        return (set(data))
-    
-    def captions_clean (self, image_dict):
-        print_count=0
-        # <key> is the image_name, which can be ignored
-        for key, captions in image_dict.items():
-            # Loop through each caption for this image
-            for i, caption in enumerate (captions):
-                # Convert the caption to lowercase, and then remove all special characters from it
-                caption_nopunct = re.sub(r"[^a-zA-Z0-9]+", ' ', caption.lower())
-                # Split the caption into separate words, and collect all words which are more than 
-                # one character and which contain only alphabets (ie. discard words with mixed alpha-numerics)
-                clean_words = [word for word in caption_nopunct.split() if ((len(word) > 1) and (word.isalpha()))]
-                # Join those words into a string
-                caption_new = ' '.join(clean_words)
-                if print_count<=10:
-                    print("\t Old caption:",captions[i])
-                        
-                # Replace the old caption in the captions list with this new cleaned caption
-                captions[i] = caption_new
-                if print_count<=10:
-                    print("\t New caption:",captions[i])
-                        
-                print_count += 1
+    def read_image(self, image_path):
+        if self.image_source is not None:
+            return self.image_source.read_tf(image_path)
+        return tf.io.read_file(image_path)
+
+    def decode_image(self, image_path):
+        # Decoded image rounded to uint8 RGB, as kept by the image cache
+        return to_uint8_tf(self.image_decoder.decode_tf(self.read_image(image_path))), image_path
 
     def load_image(self,image_path):
-        img = tf.io.read_file(image_path)
-            
-        print("\t Decoding the image with 3 color channel")
-        img = tf.image.decode_jpeg(img, channels=3)
-            
-        print("\t Resizing the image to (299, 299)")
-        img = tf.image.resize(img, (299, 299))
+        print("\t Decoding the image with 3 color channel and resizing it to (299, 299)")
+        # Large JPEGs are decoded at a reduced DCT scale. The image is rounded
+        # to uint8 like the ones of the image cache, so the features are the
+        # same with and without it
+        img, image_path = self.decode_image(image_path)
+        img = tf.cast(img, tf.float32)
             
         print("\t Pre built pre processing of Inception V3")
         img = tf.keras.applications.inception_v3.preprocess_input(img)
         return img, image_path
 
-    def process_image_dataset(self,image_dir, training_image_names):
+    def build_feature_extractor(self):
         print("Initializing Inception V3 model without the top classification layers")
-        image_model = tf.keras.applications.InceptionV3(include_top=False, weights='imagenet')
-            
-        print("Retrieving the input tensor 'new_input' and the output tensor of the last layer 'hidden_layer'")
-        new_input = image_model.input
-        hidden_layer = image_model.layers[-1].output
-            
-        print("Creating new model using the created input and output")
-        self.image_features_extract_model = tf.keras.Model(new_input, hidden_layer)
-            
+        print("Creating new model with the output of the last layer")
+        self.image_features_extract_model = build_inception_v3()
+
+    def feature_config(self):
+        # Everything which changes the extracted features, a change invalidates the cache
+        return inception_v3_config(self.image_decoder.config())
+
+    def process_image_dataset(self,image_source, training_image_names, cache_dir="datasets/features", batch_size=16,
+                              max_pending_writes=4, image_cache=None):
+        # image_source is a DirectoryImageSource or a ZipImageSource, image
+        # paths are then the names given by the source
+        # With an ImageCache, the images decoded by an earlier run are read
+        # from it instead of being decoded, and the others are added to it
+        print("Opening the feature extraction cache")
+        # Shape of the vector extracted from InceptionV3 is (64, 2048)
+        cache = ExtractionCache(cache_dir, self.feature_config(), INCEPTION_V3_FEATURE_SHAPE)
+        self.feature_store = cache.store
+
         print("Creating training image path")
-        training_image_paths = [image_dir +'/'+ name + '.jpg' for name in training_image_names]
-        encode_train = sorted(set(training_image_paths))
+        self.image_source = image_source
+        training_image_names = sorted(set(training_image_names))
+        missing_images = [name for name in training_image_names if name not in image_source]
+        if missing_images:
+            print("\t", len(missing_images), "training images are not in the image source, e.g.", missing_images[0])
+        training_image_names = [name for name in training_image_names if name in image_source]
+        training_image_paths = [image_source.name(name) for name in training_image_names]
+
+        print("Hashing the training images to find new or changed ones")
+        pending = cache.pending(training_image_names, training_image_paths, image_source.content_hash)
+        print("\t", len(pending), "of", len(training_image_names), "images have to be extracted")
+        if not pending:
+            return
+        content_hashes = {image_path: content_hash for _, image_path, content_hash in pending}
+        encode_train = [image_path for _, image_path, _ in pending]
+
+        if self.image_features_extract_model is None:
+            self.build_feature_extractor()
             
         print("Creates a TensorFlow dataset, image_dataset, from the sorted training image paths")
-        image_dataset = tf.data.Dataset.from_tensor_slices(encode_train)
-            
-        print("Pre-processing each image data:")
-        image_dataset = image_dataset.map(self.load_image, num_parallel_calls=tf.data.experimental.AUTOTUNE).batch(16)
-
-        print("Preparing the preprocessed images in groups of 16 in batches")
+        if image_cache is None:
+            image_dataset = tf.data.Dataset.from_tensor_slices(encode_train)
+
+            print("Pre-processing each image data:")
+            image_dataset = image_dataset.map(self.load_image, num_parallel_calls=tf.data.experimental.AUTOTUNE).batch(batch_size)
+            # No decoded image to keep
+            image_dataset = image_dataset.map(lambda img, path: (img, path, tf.zeros([0], tf.uint8)))
+            num_batches = -(-len(encode_train) // batch_size)
+        else:
+            cached, uncached = image_cache.split(pending)
+            print("\t", len(cached), "images read from the image cache,", len(uncached), "decoded")
+            # Taken once, the writer thread replaces the memory map as it adds images
+            cached_images = image_cache.store.array
+            cached_rows = image_cache.store.rows([image_id for image_id, _, _ in cached])
+            cached_dataset = tf.data.Dataset.from_tensor_slices((cached_rows, tf.constant([image_path for _, image_path, _ in cached], tf.string)))
+            cached_dataset = cached_dataset.batch(batch_size).map(
+                lambda rows, path: (tf.ensure_shape(tf.numpy_function(lambda rows: cached_images[rows], [rows], tf.uint8),
+                                                    (None,) + cached_images.shape[1:]), path, tf.zeros([0], tf.uint8)),
+                num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+            print("Pre-processing each image data:")
+            uncached_dataset = tf.data.Dataset.from_tensor_slices(tf.constant([image_path for _, image_path, _ in uncached], tf.string))
+            uncached_dataset = uncached_dataset.map(self.decode_image, num_parallel_calls=tf.data.experimental.AUTOTUNE).batch(batch_size)
+            # The decoded images are also passed along, to be added to the image cache
+            uncached_dataset = uncached_dataset.map(lambda img, path: (img, path, img))
+
+            preprocess = lambda img, path, decoded: (tf.keras.applications.inception_v3.preprocess_input(tf.cast(img, tf.float32)),
+                                                     path, decoded)
+            image_dataset = cached_dataset.concatenate(uncached_dataset).map(preprocess)
+            num_batches = -(-len(cached) // batch_size) + -(-len(uncached) // batch_size)
+        image_dataset = image_dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+        print("Preparing the preprocessed images in groups of", batch_size, "in batches")
         print("Extracting image features on the batch of images")
         print("Reshaping extracted features")
-        print("Saving the features as Numpy file")
-
-        for img, path in tqdm(image_dataset):
-            batch_features = self.image_features_extract_model(img)
-                  
-            batch_features = tf.reshape(batch_features, (batch_features.shape[0], -1, batch_features.shape[3]))
-                  
-            for bf, p in zip(batch_features, path):
-                path_of_feature = p.numpy().decode("utf-8")
-                np.save(path_of_feature, bf.numpy())
-
-
-    def add_token (self,captions):
-        for i, caption in enumerate (captions):
-            captions[i] = 'startseq ' + caption + ' endseq'
-            
-        return (captions)
-
-      #--------------------------------------------------
-    def subset_data_dict (self,image_dict, image_names):
-        dict = { image_name:self.add_token(captions) for image_name,captions in image_dict.items() if image_name in image_names}
-        return (dict)
-
-
-      #--------------------------------------------------
-    def all_captions (self,data_dict):
-        return ([caption for key, captions in data_dict.items() for caption in captions])
-
-
-      #--------------------------------------------------
-    def max_caption_length(self,captions):
-        return max(len(caption.split()) for caption in captions)
-
-    def create_tokenizer(self,data_dict):
-        captions = self.all_captions(data_dict)
-        max_caption_words = self.max_caption_length(captions)
-            
-        # Initialise a Keras Tokenizer
-        tokenizer = Tokenizer()
-            
-        # Fit it on the captions so that it prepares a vocabulary of all words
-        tokenizer.fit_on_texts(captions)
-            
-        # Get the size of the vocabulary
-        vocab_size = len(tokenizer.word_index) + 1
+        print("Appending the features to the feature store in the background")
 
-        return (tokenizer, vocab_size, max_caption_words)
+        def batches():
+            for img, path, decoded in image_dataset:
+                image_paths = [p.decode("utf-8") for p in path.numpy()]
+                image_ids = [os.path.basename(image_path).split('.')[0] for image_path in image_paths]
+                batch_hashes = [content_hashes[image_path] for image_path in image_paths]
+                yield image_ids, batch_hashes, img, (image_ids, batch_hashes, decoded) if decoded.shape[0] else None
 
-      #--------------------------------------------------
-    def pad_text (self,text, max_length): 
-        text = pad_sequences([text], maxlen=max_length, padding='post')[0]
-            
-        return (text)
-
-    def data_prep(self,data_dict, tokenizer, max_length, vocab_size):
-        X, y = list(), list()
-        # For each image and list of captions
-        for image_name, captions in data_dict.items():
-            image_name = image_dir + image_name + '.jpg'
-            # For each caption in the list of captions
-            for caption in captions:
-                # Convert the caption words into a list of word indices
-                word_idxs = tokenizer.texts_to_sequences([caption])[0]
-
-                # Pad the input text to the same fixed length
-                pad_idxs = self.pad_text(word_idxs, max_length)
-                        
-                X.append(image_name)
-                y.append(pad_idxs)
-            
-        return array(X), array(y)
-        return X, y
-
-    def map_func(self,img_name, cap):
-        img_name_parts = img_name.split(b"Dataset")
-        img_name = img_name_parts[0] + b"Dataset/" + img_name_parts[1]
-        img_tensor = np.load(img_name.decode('utf-8') + '.npy')
-        return img_tensor, cap
+        def extract(image_ids, batch_hashes, img):
+            batch_features = self.image_features_extract_model(img)
+            # Copied to host memory, the model runs asynchronously on a GPU and is timed until it is done
+            batch_features = tf.reshape(batch_features, (batch_features.shape[0], -1, batch_features.shape[3])).numpy()
+            return image_ids, batch_hashes, batch_features
+
+        run_extraction(batches(), [("InceptionV3", cache, extract)], image_cache, max_pending_writes, num_batches)
+
+
+    def map_batch_func(self, image_rows):
+        # Gather the image features of a whole batch out of the memory-mapped feature store
+        img_tensor = self.feature_store.array[image_rows]
+        with self.buffer_lock:
+            self.loaded_bytes += img_tensor.nbytes
+        return img_tensor
+
+    def release_batch(self, img_tensor):
+        # Called by the training loop for every batch it takes, the features
+        # loaded but not yet released are the ones buffered by the pipeline
+        with self.buffer_lock:
+            self.peak_buffer_bytes = max(self.peak_buffer_bytes, self.loaded_bytes - self.released_bytes)
+            self.released_bytes += int(tf.size(img_tensor)) * img_tensor.dtype.size
+
+    def training_dataset(self, image_rows, tokens, lengths, batch_size, buffer_size=1000, bucket_boundaries=None,
+                         group_by_image=False, memory_limit=None, host_memory_limit=0):
+        # (image feature, caption) batches for train_step
+        # Only the (image row, caption) records are shuffled and batched, the
+        # image features are loaded once a batch is formed, see load_batches
+        # Without bucket_boundaries, every caption keeps its padding up to the
+        # longest caption. With them, captions are grouped by length and each
+        # batch is only padded to the boundary of its bucket, so train_step
+        # runs fewer timesteps on padding
+        # With group_by_image, see grouped_training_dataset
+        if group_by_image:
+            return self.grouped_training_dataset(image_rows, tokens, lengths, batch_size, buffer_size, memory_limit,
+                                                 host_memory_limit)
+        max_length = tokens.shape[1]
+        dataset = tf.data.Dataset.from_tensor_slices((image_rows, tokens, lengths))
+        if bucket_boundaries:
+            dataset = dataset.map(lambda image_row, cap, length: (image_row, cap[:length]))
+        else:
+            dataset = dataset.map(lambda image_row, cap, length: (image_row, cap))
+
+        # Shuffle and batch
+        dataset = dataset.shuffle(buffer_size)
+        if bucket_boundaries:
+            # Captions are padded to one less than their bucket boundary, the last
+            # boundary takes every caption up to max_length
+            boundaries = sorted(set(b for b in bucket_boundaries if 1 < b <= max_length)) + [max_length + 1]
+            dataset = dataset.bucket_by_sequence_length(lambda image_row, cap: tf.shape(cap)[0], boundaries,
+                                                        [batch_size] * (len(boundaries) + 1),
+                                                        pad_to_bucket_boundary=True)
+        else:
+            dataset = dataset.batch(batch_size)
+        return self.load_batches(dataset, batch_size, memory_limit, host_memory_limit)
+
+    def grouped_training_dataset(self, image_rows, tokens, lengths, batch_size, buffer_size=1000, memory_limit=None,
+                                 host_memory_limit=0):
+        # (image feature, captions of the image) batches for grouped_train_step
+        # Each feature is loaded once per epoch instead of once per caption, a
+        # batch holds batch_size // captions per image images, and is trimmed
+        # to its longest caption
+        images, image_index = np.unique(image_rows, return_inverse=True)
+        image_index = image_index.reshape(-1)
+        captions_per_image = np.bincount(image_index)
+
+        # Position of each caption among the captions of its image
+        order = np.argsort(image_index, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(captions_per_image)[:-1]])
+        position = np.empty(len(image_index), dtype=np.int64)
+        position[order] = np.arange(len(image_index)) - np.repeat(starts, captions_per_image)
+
+        grouped = np.zeros((len(images), captions_per_image.max(), tokens.shape[1]), dtype=np.int32)
+        grouped[image_index, position] = tokens
+
+        images_per_batch = max(1, batch_size // grouped.shape[1])
+        dataset = tf.data.Dataset.from_tensor_slices((images, grouped))
+        dataset = dataset.shuffle(buffer_size).batch(images_per_batch)
+        dataset = dataset.map(lambda image_row, cap: (image_row, cap[:, :, :tf.reduce_max(tf.math.count_nonzero(cap, axis=2, dtype=tf.int32))]))
+        return self.load_batches(dataset, images_per_batch, memory_limit, host_memory_limit)
+
+    def shard_training_dataset(self, shard_reader, batch_size, buffer_size=1000, bucket_boundaries=None,
+                               group_by_image=False):
+        # Same batches as training_dataset, read from the TFRecord shards of
+        # pack_shards instead of the feature store
+        # The shards are read interleaved and in a new order every epoch, and
+        # buffer_size images are shuffled. Their features are part of the
+        # records, so the buffers hold features, not only rows
+        dataset = shard_reader.dataset(shuffle=True).map(lambda image_id, img, cap: (img, cap))
+        dataset = dataset.shuffle(buffer_size)
+        if group_by_image:
+            # Images are padded to the most captions in their batch, with fully masked empty captions
+            images_per_batch = max(1, batch_size // shard_reader.max_captions)
+            dataset = dataset.padded_batch(images_per_batch)
+            dataset = dataset.map(lambda img, cap: (img, cap[:, :, :tf.reduce_max(tf.math.count_nonzero(cap, axis=2, dtype=tf.int32))]))
+            return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+        # One (feature, caption) element per caption, shuffled again so the
+        # captions of an image are spread over several batches
+        dataset = dataset.flat_map(lambda img, cap: tf.data.Dataset.from_tensor_slices(
+            (tf.repeat(img[tf.newaxis], tf.shape(cap)[0], axis=0), cap)))
+        dataset = dataset.shuffle(batch_size * 4)
+        max_length = shard_reader.max_length
+        if bucket_boundaries:
+            boundaries = sorted(set(b for b in bucket_boundaries if 1 < b <= max_length)) + [max_length + 1]
+            dataset = dataset.map(lambda img, cap: (img, cap[:tf.math.count_nonzero(cap, dtype=tf.int32)]))
+            dataset = dataset.bucket_by_sequence_length(lambda img, cap: tf.shape(cap)[0], boundaries,
+                                                        [batch_size] * (len(boundaries) + 1),
+                                                        pad_to_bucket_boundary=True)
+        else:
+            dataset = dataset.batch(batch_size)
+        return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    def load_batches(self, dataset, batch_size, memory_limit=None, host_memory_limit=0):
+        # Replaces the image rows of every batch with their features
+        # Without memory_limit, the parallel loads and the prefetch depth are
+        # autotuned. With it, the loaded batches in flight, being loaded or
+        # waiting in the prefetch buffer, are kept within memory_limit bytes
+        # With host_memory_limit, a store which fits within it is copied once
+        # into a host variable and gathered in the graph, which needs no GIL and
+        # runs on as many threads as tf.data uses. The copy stays resident, so it
+        # counts against memory_limit and is only made when it leaves room for
+        # the batches. Otherwise the store is read from the memory map, one
+        # numpy_function call per batch
+        feature_shape = self.feature_store.feature_shape
+        self.loaded_bytes = 0
+        self.released_bytes = 0
+        self.peak_buffer_bytes = 0
+
+        host_bytes = self.feature_store.array.nbytes
+        batch_bytes = batch_size * self.feature_store.row_size
+        # The batch the training loop holds and one being loaded are within memory_limit too
+        use_host = host_bytes <= host_memory_limit and (not memory_limit or host_bytes + 2 * batch_bytes <= memory_limit)
+        if host_bytes <= host_memory_limit and not use_host:
+            print(f"\t Host copy of the features, {host_bytes / (1 << 20):.0f} MB, does not fit the memory limit, "
+                  "reading the memory map instead")
+
+        num_parallel_calls = prefetch = tf.data.experimental.AUTOTUNE
+        if memory_limit:
+            batches_in_flight = (memory_limit - (host_bytes if use_host else 0)) // batch_bytes - 1
+            if batches_in_flight < 1:
+                raise ValueError(f"A memory limit of {memory_limit / (1 << 20):.1f} MB cannot hold a batch being loaded "
+                                 f"and the one being trained on, at least {2 * batch_bytes / (1 << 20):.1f} MB "
+                                 "are needed")
+            num_parallel_calls = max(1, batches_in_flight // 2)
+            prefetch = batches_in_flight - num_parallel_calls
+
+        if use_host:
+            if self.host_features is None:
+                # A variable is captured by handle, the features are never
+                # copied into the dataset graph
+                with tf.device('/CPU:0'):
+                    self.host_features = tf.Variable(self.feature_store.array, trainable=False)
+            host_features = self.host_features
+            dataset = dataset.map(lambda image_row, cap: (tf.gather(host_features, image_row), cap),
+                                  num_parallel_calls=num_parallel_calls)
+        else:
+            dataset = dataset.map(lambda image_row, cap: (tf.ensure_shape(tf.numpy_function(self.map_batch_func, [image_row], tf.float32),
+                                                                          (None,) + feature_shape), cap),
+                                  num_parallel_calls=num_parallel_calls)
+        if prefetch:
+            dataset = dataset.prefetch(buffer_size=prefetch)
+        if memory_limit:
+            options = tf.data.Options()
+            options.autotune.ram_budget = int(memory_limit)
+            dataset = dataset.with_options(options)
+        return dataset
 
     def loss_function(self,real, pred):
         mask = tf.math.logical_not(tf.math.equal(real, 0))
@@ -320,26 +451,52 @@ class ImageCaptioning():
 
         return tf.reduce_mean(loss_)
 
-    @tf.function
-    def train_step(self,img_tensor, target):
-        loss = 0
+    def teacher_forced_step(self,img_tensor, target):
+        # Python side effect, only runs while the function is traced
+        self.trace_counts['train_step'] += 1
+        return self.optimize_captions(img_tensor, target)
+
+    def grouped_teacher_forced_step(self, img_tensor, captions):
+        # Python side effect, only runs while the function is traced
+        self.trace_counts['grouped_train_step'] += 1
+
+        # captions shape == (images, captions per image, length), images with
+        # fewer captions are padded with empty captions, which are fully masked
+        target = tf.reshape(captions, [-1, tf.shape(captions)[2]])
+        image_index = tf.repeat(tf.range(tf.shape(captions)[0]), tf.shape(captions)[1])
+        return self.optimize_captions(img_tensor, target, image_index)
+
+    def optimize_captions(self, img_tensor, target, image_index=None):
+        # One teacher-forced optimization step, image_index is the row of the
+        # image of every caption in img_tensor, when the images are grouped
         # initializing the hidden state for each batch
         # because the captions are not related from image to image
-        hidden = decoder.reset_state(batch_size=target.shape[0])
-
-        dec_input = tf.expand_dims([tokenizer.word_index['startseq']] * target.shape[0], 1)
+        hidden = decoder.reset_state(batch_size=tf.shape(target)[0])
 
         with tf.GradientTape() as tape:
             features = encoder(img_tensor)
-            for i in range(1, target.shape[1]):
+            keys = decoder.attention_keys(features)
+            if image_index is not None:
+                # Encoded once per image, then broadcast to the captions of the image
+                features = tf.gather(features, image_index)
+                keys = tf.gather(keys, image_index)
+
+            # Every caption starts with 'startseq', so the decoder inputs are the
+            # target without its last word, embedded all at once, time major
+            dec_inputs = tf.transpose(decoder.embedding(target[:, :-1]), [1, 0, 2])
+            dec_targets = tf.transpose(target[:, 1:])
+
+            # tf.range turns this into a single while loop in the graph instead
+            # of one copy of the decoder per timestep
+            loss = tf.constant(0.0)
+            for i in tf.range(tf.shape(dec_targets)[0]):
                 # passing the features through the decoder
-                predictions, hidden, _ = decoder(dec_input, features, hidden)
+                predictions, hidden, _ = decoder.step(tf.expand_dims(dec_inputs[i], 1), features, hidden, keys)
 
-                loss += self.loss_function(target[:, i], predictions)
                 # using teacher forcing
-                dec_input = tf.expand_dims(target[:, i], 1)
+                loss += self.loss_function(dec_targets[i], predictions)
 
-            total_loss = (loss / int(target.shape[1]))
+            total_loss = (loss / tf.cast(tf.shape(target)[1], loss.dtype))
 
             trainable_variables = encoder.trainable_variables + decoder.trainable_variables
 
@@ -349,11 +506,18 @@ class ImageCaptioning():
 
             return loss, total_loss
 
+    def decoder_step(self, dec_input, features, hidden, keys):
+        # Python side effect, only runs while the function is traced
+        self.trace_counts['decode_step'] += 1
+        return decoder(dec_input, features, hidden, keys)
+
     def evaluate(self,image, max_length):
         attention_plot = np.zeros((max_length, attention_features_shape))
 
         hidden = decoder.reset_state(batch_size=1)
 
+        if self.image_features_extract_model is None:
+            self.build_feature_extractor()
         temp_input = tf.expand_dims(self.load_image(image)[0], 0)
         img_tensor_val = self.image_features_extract_model(temp_input)
         img_tensor_val = tf.reshape(img_tensor_val, (img_tensor_val.shape[0],
@@ -362,13 +526,16 @@ class ImageCaptioning():
 
         features = encoder(img_tensor_val)
 
+        keys = decoder.attention_keys(features)
+
         dec_input = tf.expand_dims([tokenizer.word_index['startseq']], 0)
         result = []
 
         for i in range(max_length):
-            predictions, hidden, attention_weights = decoder(dec_input,
-                                                                  features,
-                                                                  hidden)
+            predictions, hidden, attention_weights = self.decode_step(dec_input,
+                                                                      features,
+                                                                      hidden,
+                                                                      keys)
 
             attention_plot[i] = tf.reshape(attention_weights, (-1, )).numpy()
 
@@ -384,20 +551,156 @@ class ImageCaptioning():
         return result, attention_plot
 
 
-    def check_test(self,test_image_names, image_dict, image_dir, max_caption_words):
+    def extract_features(self, images):
+        # InceptionV3 features of a batch of images, shape == (batch_size, 64, 2048)
+        # The images are image paths or decoded (height, width, 3) RGB arrays
+        img = []
+        for image in images:
+            if isinstance(image, (str, bytes)):
+                img.append(self.load_image(image)[0])
+            else:
+                image = self.image_decoder.resize_tf(image)
+                img.append(tf.keras.applications.inception_v3.preprocess_input(image))
+        img = tf.stack(img)
+        if self.image_features_extract_model is None:
+            self.build_feature_extractor()
+        img_tensor_val = self.image_features_extract_model(img)
+        return tf.reshape(img_tensor_val, (img_tensor_val.shape[0], -1, img_tensor_val.shape[3]))
+
+    def caption_batch(self, images, max_length):
+        # Greedy captions for a batch of image paths or RGB arrays, decoded together
+        start_id = tokenizer.word_index['startseq']
+        end_id = tokenizer.word_index['endseq']
+
+        features = encoder(self.extract_features(images))
+        keys = decoder.attention_keys(features)
+        num_images = int(features.shape[0])
+        hidden = decoder.reset_state(batch_size=num_images)
+        dec_input = tf.fill([num_images, 1], start_id)
+
+        # Output row of each caption which is still being decoded
+        active = np.arange(num_images)
+        caption_ids = np.zeros((num_images, max_length), dtype=np.int32)
+
+        for i in range(max_length):
+            predictions, hidden, _ = self.decode_step(dec_input, features, hidden, keys)
+            predicted_ids = tf.argmax(predictions, axis=-1, output_type=tf.int32)
+
+            # A single host copy per step for the whole batch
+            predicted = predicted_ids.numpy()
+            caption_ids[active, i] = predicted
+
+            # Captions which emitted endseq are dropped from the batch
+            running = predicted != end_id
+            if not running.all():
+                active = active[running]
+                if len(active) == 0:
+                    break
+                features = tf.boolean_mask(features, running)
+                keys = tf.boolean_mask(keys, running)
+                hidden = tf.boolean_mask(hidden, running)
+                predicted_ids = tf.boolean_mask(predicted_ids, running)
+
+            dec_input = tf.expand_dims(predicted_ids, 1)
+
+        captions = []
+        for ids in caption_ids:
+            words = []
+            for word_id in ids:
+                if word_id == 0 or word_id == end_id:
+                    break
+                words.append(tokenizer.index_word[word_id])
+            captions.append(' '.join(words))
+        return captions
+
+    def beam_search(self, img_tensor_val, max_length, beam_width=3, length_penalty=0.7, n_best=1):
+        # All beams of all images are decoded together as one batch of
+        # batch_size * beam_width rows, row b * beam_width + k being beam k of image b
+        batch_size = int(img_tensor_val.shape[0])
+        start_id = tokenizer.word_index['startseq']
+        end_id = tokenizer.word_index['endseq']
+
+        # The encoder output and the attention keys are tiled once for all beams
+        features = encoder(img_tensor_val)
+        keys = decoder.attention_keys(features)
+        features = tf.repeat(features, beam_width, axis=0)
+        keys = tf.repeat(keys, beam_width, axis=0)
+        hidden = decoder.reset_state(batch_size=batch_size * beam_width)
+        dec_input = tf.fill([batch_size * beam_width, 1], start_id)
+
+        # Only the first beam is alive at the start, so the first step does not
+        # select the same word beam_width times
+        scores = tf.tile([[0.0] + [-np.inf] * (beam_width - 1)], [batch_size, 1])
+        lengths = tf.zeros([batch_size, beam_width], dtype=tf.int32)
+        finished = tf.zeros([batch_size, beam_width], dtype=tf.bool)
+        tokens = tf.zeros([batch_size, beam_width, 0], dtype=tf.int32)
+        beam_offsets = tf.range(batch_size)[:, None] * beam_width
+
+        for i in range(max_length):
+            predictions, hidden, _ = self.decode_step(dec_input, features, hidden, keys)
+            vocab_size = predictions.shape[-1]
+            log_probs = tf.reshape(tf.nn.log_softmax(predictions), [batch_size, beam_width, vocab_size])
+
+            # A finished beam can only be extended with padding, at no cost, and
+            # a live beam never with padding
+            pad_only = tf.one_hot(0, vocab_size, on_value=0.0, off_value=-np.inf)
+            no_pad = tf.one_hot(0, vocab_size, on_value=-np.inf, off_value=0.0)
+            log_probs = tf.where(finished[..., None], pad_only, log_probs + no_pad)
+            candidates = scores[..., None] + log_probs
+
+            # Candidates are ranked on their length-normalized score
+            candidate_lengths = lengths + tf.cast(tf.logical_not(finished), tf.int32)
+            normalized = candidates / tf.pow(tf.cast(candidate_lengths, tf.float32), length_penalty)[..., None]
+            _, top_idx = tf.math.top_k(tf.reshape(normalized, [batch_size, -1]), k=beam_width)
+            beam_idx = top_idx // vocab_size
+            word_idx = tf.cast(top_idx % vocab_size, tf.int32)
+
+            scores = tf.gather(tf.reshape(candidates, [batch_size, -1]), top_idx, batch_dims=1)
+            lengths = tf.gather(candidate_lengths, beam_idx, batch_dims=1)
+            finished = tf.logical_or(tf.gather(finished, beam_idx, batch_dims=1), tf.equal(word_idx, end_id))
+            tokens = tf.concat([tf.gather(tokens, beam_idx, batch_dims=1), word_idx[..., None]], axis=2)
+
+            # Reorder the GRU hidden state to follow the selected beams
+            hidden = tf.gather(hidden, tf.reshape(beam_offsets + beam_idx, [-1]))
+            dec_input = tf.reshape(word_idx, [-1, 1])
+
+            if bool(tf.reduce_all(finished)):
+                break
+
+        normalized = (scores / tf.pow(tf.cast(tf.maximum(lengths, 1), tf.float32), length_penalty)).numpy()
+        tokens = tokens.numpy()
+
+        # n-best list per image, best first, as (caption, normalized score)
+        results = []
+        for b in range(batch_size):
+            n_best_list = []
+            for k in np.argsort(-normalized[b])[:n_best]:
+                words = []
+                for word_id in tokens[b, k]:
+                    if word_id == 0 or word_id == end_id:
+                        break
+                    words.append(tokenizer.index_word[word_id])
+                n_best_list.append((' '.join(words), float(normalized[b, k])))
+            results.append(n_best_list)
+        return results
+
+    def check_test(self,test_image_names, image_dict, image_source, max_caption_words, beam_width=3):
         # captions on the validation set
         rid = np.random.randint(0, len(test_image_names))
         image_name = test_image_names[rid]
         # real_caption = image_dict[image_name]
         if image_name in image_dict:
             real_caption = image_dict[image_name]
-            image_path = image_dir +'/'+image_name + '.jpg'
+            image_path = image_source.name(image_name)
             result, attention_plot = self.evaluate(image_path, max_caption_words)
 
             #from IPython.display import Image, display
             #display(Image(image_path))
             print('Real Caption:', real_caption)
             print('Prediction Caption:', ' '.join(result))
+
+            beam_caption, beam_score = self.beam_search(self.extract_features([image_path]), max_caption_words, beam_width)[0][0]
+            print('Beam Search Caption:', beam_caption)
     # Rest of your code
         else:
             print(f"Key '{image_name}' not found in image_dict.")
@@ -418,40 +721,62 @@ class ImageCaptioning():
    
 
 # Instantiate the ImageCaptioning
-attention=ImageCaptioning()
+# JIT_COMPILE=1 compiles the training step with XLA
+# JPEG_DCT_SCALING, IMAGE_CROP and IMAGE_RESIZE_METHOD set up the decoding, see ImageDecoder.from_env
+image_decoder = ImageDecoder.from_env((299, 299))
+embedding_dim = 256
+units = 512
+attention=ImageCaptioning(jit_compile=os.environ.get('JIT_COMPILE', '0') == '1', image_decoder=image_decoder,
+                          embedding_dim=embedding_dim, units=units)
 
 print("Retrieving text files from zip folder")
-doc = attention.load_captions("datasets/download_ds_file.zip","Flickr8k.token.txt")
-image_dict = attention.captions_dict (doc)
+# Streamed into a compact index, which is also used as the image_dict
+image_dict = CaptionIndex.from_zip("datasets/download_ds_file.zip","Flickr8k.token.txt")
 
 print("Retrieving names of training images from text file")
-training_imgname_doc = attention.load_captions("datasets/download_ds_file.zip","Flickr_8k.trainImages.txt")
-training_image_names = attention.subset_image_name (training_imgname_doc)
+training_mask = image_dict.split_mask("datasets/download_ds_file.zip","Flickr_8k.trainImages.txt")
+training_image_names = image_dict.image_names(training_mask)
 
-print("Preprocessing captions:")
-attention.captions_clean (image_dict)
-
-print("Extracting images:")
+print("Opening the images:")
 
-# Path to the extracted folder
-image_dir = "datasets/Flicker8k_Dataset"
-# List all files in the extracted folder
-file_names = os.listdir(image_dir)
-# print(file_names)
+# IMAGE_SOURCE can point to the image folder or to the zip file, see default_image_source
+image_source = default_image_source()
+print("\t", len(image_source.image_ids()), "images in", type(image_source).__name__)
 
 print("Images Extracted")
 training_image_paths = []
-attention.process_image_dataset(image_dir, training_image_names)
 
-training_dict = attention.subset_data_dict (image_dict, training_image_names)
-# Prepare tokenizer
-tokenizer, vocab_size, max_caption_words = attention.create_tokenizer(training_dict)
+# BENCHMARK_DECODE=1 reports the decode cost per megapixel of the first training images
+if os.environ.get('BENCHMARK_DECODE', '0') == '1':
+    benchmark_images = [image_source.name(name) for name in training_image_names[:200] if name in image_source]
+    for path, cost in benchmark_decode(benchmark_images, (299, 299), image_decoder.resize_method, read=image_source.read).items():
+        print(f"\t Decode {path}: {cost:.2f} ms per megapixel")
+
+# IMAGE_CACHE_MB=<budget> keeps the decoded 299x299 images, so extracting with another backbone skips the decoding
+image_cache_bytes = int(float(os.environ.get('IMAGE_CACHE_MB', 0)) * (1 << 20))
+image_cache = ImageCache("datasets/images", {'decoder': 'tf', **image_decoder.config()}, image_cache_bytes) if image_cache_bytes else None
+
+# EXTRACT_BATCH_SIZE is the number of images run through InceptionV3 at once
+attention.process_image_dataset(image_source, training_image_names, batch_size=int(os.environ.get('EXTRACT_BATCH_SIZE', 16)),
+                                image_cache=image_cache)
+
+print("Preprocessing captions:")
+# Cleaning, start/end tokens, encoding and padding in a single pass
+caption_encoder = CaptionEncoder(num_workers=int(os.environ.get('CAPTION_WORKERS', 0)))
+# Reused as is while the caption file, the cleaning rules and the training split are unchanged
+caption_cache = CaptionCache("datasets/captions", "attention")
 
 print("Data Preparation")
-train_X, train_y = attention.data_prep(training_dict, tokenizer, max_caption_words, vocab_size)
+# Prepare the vocabulary on the training captions and encode them
+tokenizer, train_captions = caption_encoder.fit_encode(image_dict, training_mask, training_mask, cache=caption_cache)
+vocab_size = len(tokenizer.word_index) + 1
+max_caption_words = train_captions.tokens.shape[1]
+train_X = attention.feature_store.rows(train_captions.image_ids)[train_captions.image_index]
+train_y = train_captions.tokens
 
 # BATCH_SIZE = 64
-BUFFER_SIZE = 1000
+# Only (image row, caption) records are shuffled, so a full shuffle is cheap
+BUFFER_SIZE = len(train_X)
 # Convert epoch number and batch size to integers
 epoch_number = int(os.environ.get('EPOCH_NUMBER'))
 batch_size = int(os.environ.get('BATCH_SIZE'))
@@ -459,19 +784,58 @@ batch_size = int(os.environ.get('BATCH_SIZE'))
 print("\t Epoch number:", epoch_number)
 print("\t Batch number:", batch_size)
 
-dataset = tf.data.Dataset.from_tensor_slices((train_X, train_y))
-
-# Use map to load the numpy files in parallel
-dataset = dataset.map(lambda item1, item2: tf.numpy_function(attention.map_func, [item1, item2], [tf.float32, tf.int32]),num_parallel_calls=tf.data.experimental.AUTOTUNE)
+# BUCKET_BOUNDARIES="10,14,18" batches the captions by length, empty pads them all to max_caption_words
+bucket_boundaries = [int(b) for b in os.environ.get('BUCKET_BOUNDARIES', '').split(',') if b.strip()]
+print("\t Bucket boundaries:", bucket_boundaries or "none")
+
+# Share of the decoder timesteps which would run on padding with a single length
+word_steps = int(np.sum(train_captions.lengths - 1))
+print(f"\t Padding waste without bucketing: {1 - word_steps / (len(train_y) * (max_caption_words - 1)):.1%}")
+
+# GROUP_BY_IMAGE=1 loads and encodes each image once for all its captions, bucketing is then not used
+group_by_image = os.environ.get('GROUP_BY_IMAGE', '0') == '1'
+print("\t Grouped by image:", group_by_image)
+train_step = attention.grouped_train_step if group_by_image else attention.train_step
+
+# MEMORY_LIMIT_MB caps the loaded image features kept ahead of training, unset lets tf.data autotune it
+memory_limit = int(float(os.environ.get('MEMORY_LIMIT_MB', 0)) * (1 << 20)) or None
+print("\t Memory limit:", f"{memory_limit / (1 << 20):.0f} MB" if memory_limit else "autotuned")
+
+# HOST_FEATURES_MB is the largest feature store copied to host memory and gathered from there in the
+# graph, without the GIL, instead of the memory map. The copy counts against MEMORY_LIMIT_MB. Unset,
+# the memory map is always used, the workflow sets it
+host_memory_limit = int(float(os.environ.get('HOST_FEATURES_MB', 0)) * (1 << 20))
+
+# TFRECORD_DIR=<folder> packs the features and captions into TFRecord shards, once, and trains from them
+shard_dir = os.environ.get('TFRECORD_DIR')
+if shard_dir:
+    shard_reader = pack_shards(os.path.join(shard_dir, "attention"), train_captions.image_ids, train_captions.image_index,
+                               train_y, train_captions.lengths, tokenizer.words, store=attention.feature_store)
+    print(f"\t Training from {len(shard_reader.files)} shards, {shard_reader.nbytes() / (1 << 20):.0f} MB")
+    # SHARD_SHUFFLE_IMAGES is the number of image features in the shuffle buffer
+    dataset = attention.shard_training_dataset(shard_reader, batch_size, int(os.environ.get('SHARD_SHUFFLE_IMAGES', 1000)),
+                                               bucket_boundaries, group_by_image)
+else:
+    dataset = attention.training_dataset(train_X, train_y, train_captions.lengths, batch_size, BUFFER_SIZE, bucket_boundaries,
+                                         group_by_image, memory_limit, host_memory_limit)
+# BENCHMARK_LOADING=1 compares the feature loading paths before training
+if os.environ.get('BENCHMARK_LOADING', '0') == '1':
+    # The host copy training uses is reused, none is made past HOST_FEATURES_MB or MEMORY_LIMIT_MB
+    for path, examples_per_second in benchmark_loading(attention.feature_store, batch_size, host_features=attention.host_features,
+                                                       host_memory_limit=min(host_memory_limit, memory_limit or host_memory_limit)).items():
+        if examples_per_second is None:
+            print(f"\t Feature loading, {path}: skipped, the store does not fit HOST_FEATURES_MB")
+        else:
+            print(f"\t Feature loading, {path}: {examples_per_second:.0f} examples/s")
 
-# Shuffle and batch
-dataset = dataset.shuffle(BUFFER_SIZE).batch(batch_size)
-dataset = dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+if shard_dir:
+    print("\t Image features read from the TFRecord shards")
+elif attention.host_features is not None:
+    print(f"\t Image features gathered from host memory, {attention.feature_store.array.nbytes / (1 << 20):.0f} MB")
+else:
+    print("\t Image features read from the memory-mapped feature store")
 
-embedding_dim = 256
-units = 512
 vocab_size = vocab_size
-num_steps = len(train_X) // batch_size
 # Shape of the vector extracted from InceptionV3 is (64, 2048)
 # These two variables represent that vector shape
 features_shape = 2048
@@ -492,29 +856,55 @@ print("Training")
 for epoch in range(start_epoch, epoch_number):
     start = time.time()
     total_loss = 0
+    # Batches taken, their count depends on the bucketing and the grouping
+    num_batches = 0
+    # Decoder timesteps run, and those of them on padding
+    decoder_steps = 0
+    padding_steps = 0
 
     for (batch, (img_tensor, target)) in enumerate(dataset):
-        batch_loss, t_loss = attention.train_step(img_tensor, target)
+        attention.release_batch(img_tensor)
+        batch_loss, t_loss = train_step(img_tensor, target)
         total_loss += t_loss
+        num_batches += 1
+        decoder_steps += int(tf.size(target[..., 1:]))
+        padding_steps += int(tf.size(target[..., 1:])) - int(tf.math.count_nonzero(target[..., 1:]))
 
         if batch % 100 == 0:
-            average_batch_loss = batch_loss.numpy()/int(target.shape[1])
+            average_batch_loss = batch_loss.numpy()/int(target.shape[-1])
             print(f'Epoch {epoch+1} Batch {batch} Loss {average_batch_loss:.4f}')
         # storing the epoch end loss value to plot later
       
-    loss_plot.append(total_loss / num_steps)
+    loss_plot.append(total_loss / max(num_batches, 1))
 
-    print(f'Epoch {epoch+1} Loss {total_loss/num_steps:.6f}')
-    print(f'Time taken for 1 epoch {time.time()-start:.2f} sec\n')
+    print(f'Epoch {epoch+1} Loss {total_loss/max(num_batches, 1):.6f}')
+    print(f'Time taken for 1 epoch {time.time()-start:.2f} sec')
+    print(f'Padding waste {padding_steps / max(decoder_steps, 1):.1%} of {decoder_steps} decoder timesteps')
+    if attention.host_features is not None:
+        # The gather runs in the graph, the batches it buffers are not counted
+        print(f'Image features held in host memory {attention.feature_store.array.nbytes / (1 << 20):.1f} MB')
+    elif not shard_dir:
+        print(f'Peak buffered image features {attention.peak_buffer_bytes / (1 << 20):.1f} MB')
+    # The first batch traces twice while the variables are created, after that
+    # the count must not grow, every retrace is a stall
+    print(f'train_step traced {attention.trace_counts["grouped_train_step" if group_by_image else "train_step"]} time(s)\n')
 
 
 print("Evaluating the model with test set:")
-print("\t Retrieving test text files from zip folder")
-test_imgname_doc = attention.load_captions("datasets/download_ds_file.zip","Flickr_8k.trainImages.txt")
-# test_image_dict = attention.captions_dict (test_imgname_doc)
 print("\t Retrieving names of testing images from text file")
-test_image_names = attention.subset_image_name(test_imgname_doc)
-attention.check_test(list(test_image_names), image_dict, image_dir, max_caption_words)
+test_mask = image_dict.split_mask("datasets/download_ds_file.zip","Flickr_8k.trainImages.txt")
+test_image_names = image_dict.image_names(test_mask)
+beam_width = int(os.environ.get('BEAM_WIDTH', 3))
+attention.check_test(list(test_image_names), image_dict, image_source, max_caption_words, beam_width)
+
+print("\t Captioning a batch of test images")
+test_batch_names = sorted(test_image_names)[:batch_size]
+test_batch_captions = attention.caption_batch([image_source.name(name) for name in test_batch_names], max_caption_words)
+for image_name, caption in zip(test_batch_names, test_batch_captions):
+    print(image_name, ':', caption)
+image_source.close()
+
 
 
 
+print("\t Traced functions:", dict(attention.trace_counts))
@@ -0,0 +1,140 @@
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+import time
+from contextlib import ExitStack
+import tensorflow as tf
+from tqdm import tqdm
+
+from FeatureStore import FeatureWriter
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+# Shape of the vector extracted from InceptionV3 for the attention model
+INCEPTION_V3_FEATURE_SHAPE = (64, 2048)
+
+# Shape of the fc2 vector extracted from VGG16 for the baseline model
+VGG16_FEATURE_SHAPE = (4096,)
+
+
+def inception_v3_config(image_config):
+    """
+    Everything which changes the InceptionV3 features, a change invalidates the cache
+
+    image_config holds the settings of the decoded images, see ImageDecoder.config.
+    The decoded images are always rounded to uint8, cached or not
+    """
+    return {'backbone': 'inception_v3',
+            'weights': 'imagenet',
+            'output': 'last_layer',
+            'preprocessing': 'inception_v3.preprocess_input',
+            'pixels': 'uint8',
+            **image_config}
+
+
+def vgg16_config(image_config):
+    """
+    Everything which changes the VGG16 features, a change invalidates the cache
+
+    The images are given to VGG16 in OpenCV's BGR order. image_config holds
+    the settings of the decoded images, with the 'decoder' which produced them
+    """
+    return {'backbone': 'vgg16',
+            'weights': 'imagenet',
+            'output': 'fc2',
+            'preprocessing': 'vgg16.preprocess_input',
+            **image_config}
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+def build_inception_v3():
+    """
+    Returns InceptionV3 without its top classification layers, with the
+    output of its last layer, of shape (batch, 8, 8, 2048)
+    """
+    image_model = tf.keras.applications.InceptionV3(include_top=False, weights='imagenet')
+    return tf.keras.Model(image_model.input, image_model.layers[-1].output)
+
+
+def build_vgg16():
+    """
+    Returns VGG16 with the output of its fc2 layer, of shape (batch, 4096)
+    """
+    model = tf.keras.applications.VGG16()
+    return tf.keras.Model(inputs=model.inputs, outputs=model.layers[-2].output)
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+def run_extraction(batches, stages, image_cache=None, max_pending_writes=4, num_batches=None, num_images=None):
+    """
+    This function runs the decode, infer and write loop of a feature extraction
+
+    Arguments:
+    - batches: iterable of (image_ids, content_hashes, images, decoded)
+      batches, decoded being the (image_ids, content_hashes, uint8 images)
+      to add to image_cache, or None
+    - stages: list of (name, cache, extract), one per backbone. extract is
+      called with (image_ids, content_hashes, images) and returns the
+      (image_ids, content_hashes, features) to add to the ExtractionCache
+      cache, or None when the batch has nothing for it. The features are
+      numpy arrays, so the backbone has finished when they are returned
+    - image_cache: ImageCache the decoded images are added to, or None
+    - max_pending_writes: number of batches which can wait for each writer thread
+    - num_batches: number of batches, for the progress bar
+    - num_images: number of images the batches should hold, the ones they
+      dropped are reported as skipped
+
+    Explanation:
+    Every cache, and the image cache, has its own writer thread, so the
+    features are written while the next batch is decoded and inferred.
+    Every batch is logged as it is written, so an interrupted run resumes
+    after the last one. Once every batch is written the stores are flushed,
+    and the rows of re-extracted images are reclaimed before training
+    gathers from them. The throughput of each stage is printed, a stage well
+    below the others is the bottleneck
+    """
+    # Seconds spent waiting for decoded images and running each backbone
+    decode_time = 0.0
+    infer_times = [0.0] * len(stages)
+    images_read = 0
+    with ExitStack() as writers:
+        feature_writers = [writers.enter_context(FeatureWriter(cache.add, max_pending_writes)) for _, cache, _ in stages]
+        image_writer = writers.enter_context(FeatureWriter(image_cache.add, max_pending_writes)) if image_cache is not None else None
+
+        start = time.perf_counter()
+        for image_ids, content_hashes, images, decoded in tqdm(batches, total=num_batches):
+            decode_time += time.perf_counter() - start
+            images_read += len(image_ids)
+            if image_writer is not None and decoded is not None and len(decoded[0]):
+                image_writer.put(*decoded)
+
+            for s, (_, _, extract) in enumerate(stages):
+                start = time.perf_counter()
+                extracted = extract(image_ids, content_hashes, images)
+                infer_times[s] += time.perf_counter() - start
+                if extracted is not None:
+                    feature_writers[s].put(*extracted)
+            start = time.perf_counter()
+
+    for _, cache, _ in stages:
+        cache.store.flush()
+        cache.store.compact()
+    if image_cache is not None:
+        image_cache.store.flush()
+
+    if num_images is not None and images_read < num_images:
+        print("\t", num_images - images_read, "images could not be read and were skipped")
+    if images_read:
+        print(f"\t decode: {images_read / max(decode_time, 1e-9):.1f} images/s waiting on the input pipeline")
+        for (name, _, _), writer, infer_time in zip(stages, feature_writers, infer_times):
+            if not writer.images_written:
+                continue
+            print(f"\t {name} infer: {writer.images_written / max(infer_time, 1e-9):.1f} images/s, "
+                  f"write: {writer.images_written / max(writer.write_time, 1e-9):.1f} images/s")
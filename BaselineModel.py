@@ -5,18 +5,22 @@
 import os
 import pickle
 import numpy as np
-from tqdm import tqdm
-from tensorflow.keras.applications.vgg16 import VGG16, preprocess_input
+import tensorflow as tf
+from tensorflow.keras.applications.vgg16 import preprocess_input
 from tensorflow.keras.preprocessing.image import load_img, img_to_array
 from tensorflow.keras.preprocessing.text import Tokenizer
 from tensorflow.keras.preprocessing.sequence import pad_sequences
 from tensorflow.keras.models import Model
-from tensorflow.keras.utils import to_categorical
 from tensorflow.keras.layers import Input, Dense, LSTM, Embedding, Dropout, add
-import cv2
 from nltk.translate.bleu_score import corpus_bleu
-import zipfile
-from sklearn.model_selection import train_test_split
+from concurrent.futures import ThreadPoolExecutor
+
+from Backbones import VGG16_FEATURE_SHAPE, build_vgg16, run_extraction, vgg16_config
+from FeatureStore import ExtractionCache, ImageCache
+from CaptionPreprocessing import CaptionCache, CaptionIndex, Vocabulary
+from ImagePreprocessing import ImageDecoder, benchmark_decode, to_uint8_tf
+from ImageSource import default_image_source
+from TFRecordShards import pack_shards
 
 
 #-----------------------------------------------------------------
@@ -25,6 +29,8 @@ from sklearn.model_selection import train_test_split
 
 class ImageCaptionGenerator:
 
+    # Version of the clean_captions rules and tokenizer settings, to be bumped whenever they change
+    CLEANING_RULES = 'clean_captions-tokenizer-1'
 
 #-----------------------------------------------------------------
 #-----------------------------------------------------------------
@@ -42,11 +48,22 @@ class ImageCaptionGenerator:
         self.model = None
         self.encoder=None
         self.decoder = None
+        self.image_projection = None
+        self.step_decoder = None
         self.tokenizer = None
+        self.index_word = None
         self.max_length = None
         self.vocab_size = None
         self.features = None
         self.mapping = None
+        self.caption_index = None
+        # Decoding and resizing of the images fed to VGG16
+        self.image_decoder = ImageDecoder((224, 224))
+        # Directory or zip file the image paths are read from, None for plain files
+        self.image_source = None
+        # Decoder of the 299x299 attention model images, when the 224x224
+        # images are resized from them, see DualExtraction.py
+        self.shared_decoder = None
 
 #-----------------------------------------------------------------
 #-----------------------------------------------------------------
@@ -62,45 +79,143 @@ class ImageCaptionGenerator:
         Prebuilt VGG16 encoder model is implemented in this function
         & assigned in the variable encoder of the class
         """
-        # Load VGG16 model
-        model = VGG16()
-        # Restructure the model
-        model = Model(inputs=model.inputs, outputs=model.layers[-2].output)
-        self.encoder = model
+        # Load VGG16 model, restructured to output its fc2 layer
+        self.encoder = build_vgg16()
 
 #-----------------------------------------------------------------
 #-----------------------------------------------------------------
 
-    def load_image_features(self, folder_path):
+    def read_image(self, file_path):
+        """
+        This function reads and resizes a single image
+
+        Arguments:
+        - self: ImageCaptionGenerator class variables
+        - file_path: path of the image file
+
+        Explanation:
+        Returns the BGR image resized to 224x224 by image_decoder, or None if
+        the image couldn't be loaded. The file path is a name of image_source
+        when it is set. Large JPEGs are decoded at a reduced DCT scale.
+        OpenCV releases the GIL while decoding, so this can run in worker threads.
+        With a shared_decoder, the image is decoded by TensorFlow like in
+        DualExtraction.py instead, and converted to BGR
+        """
+        if self.image_source is None and self.shared_decoder is None:
+            return self.image_decoder.read_cv2(file_path)
+        try:
+            if self.image_source is not None:
+                data = self.image_source.read(file_path)
+            else:
+                with open(file_path, 'rb') as file:
+                    data = file.read()
+        except (OSError, KeyError):
+            return None
+        if self.shared_decoder is None:
+            return self.image_decoder.decode_cv2(data)
+        try:
+            img = self.shared_decoder.decode_sizes_tf(tf.constant(data), [self.image_decoder.target_size])[0]
+        except tf.errors.InvalidArgumentError:
+            return None
+        return to_uint8_tf(img).numpy()[..., ::-1]
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def image_config(self):
+        # Settings of the decoded 224x224 images, for the image and feature caches
+        if self.shared_decoder is not None:
+            return self.shared_decoder.shared_config(self.image_decoder.target_size)
+        return {'decoder': 'cv2', **self.image_decoder.config()}
+
+    def feature_config(self):
+        # Everything which changes the extracted features, a change invalidates the cache
+        return vgg16_config(self.image_config())
+
+    def load_image_features(self, image_source, cache_dir="datasets/features", batch_size=32, num_workers=None,
+                            max_pending_writes=4, image_cache=None):
         """
         This function extracts important features from the input images 
 
         Arguments:
         - self: ImageCaptionGenerator class variables
-        - folder_path: folder path where the images are stored
+        - image_source: DirectoryImageSource or ZipImageSource the images are read from
+        - cache_dir: folder of the feature extraction cache
+        - batch_size: number of images passed through VGG16 at once
+        - num_workers: number of image decode/resize threads, defaults to the CPU count
+        - max_pending_writes: number of extracted batches which can wait for the writer thread
+        - image_cache: optional ImageCache the decoded images are read from and added to
 
         Explanation:
         This function extracts the features from the input images with the help of 
-        the VGG16 model and saves them into a variable called features of the 
-        ImageCaptionGenerator class
+        the VGG16 model and appends them to the feature store saved in the variable
+        called features of the ImageCaptionGenerator class. The store is keyed by
+        the VGG16 configuration, and images whose content hash is already in it
+        are skipped, so VGG16 is only loaded when there is something to extract.
+        Worker threads decode and resize the next batch while the current one runs
+        through VGG16, every batch is padded to batch_size so the encoder
+        always sees the same input shape, and a writer thread appends the
+        features to the store. The throughput of each stage is printed.
+        With an image cache, the images decoded by an earlier run are read
+        from it, OpenCV's BGR images are kept in the cache as RGB
         """
-        file_names = os.listdir(folder_path)
-        features = {}  # Initialize an empty dictionary to store image features
-        for file in tqdm(file_names):
-            file_path = os.path.join(folder_path, file)
-            img = cv2.imread(file_path)
-            if img is None:
-                continue  # Skip this image if it couldn't be loaded
-
-            target_size = (224, 224)
-            img = cv2.resize(img, target_size)
-            image = img_to_array(img)
-            image = image.reshape((1, image.shape[0], image.shape[1], image.shape[2]))
+        cache = ExtractionCache(cache_dir, self.feature_config(), VGG16_FEATURE_SHAPE)
+        features = cache.store
+        self.image_source = image_source
+        image_ids = image_source.image_ids()
+        pending = cache.pending(image_ids, [image_source.name(image_id) for image_id in image_ids],
+                                image_source.content_hash)
+        print("\t", len(pending), "of", len(image_ids), "images have to be extracted")
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+
+        cached_rows = {}
+        if image_cache is not None:
+            cached, uncached = image_cache.split(pending)
+            print("\t", len(cached), "images read from the image cache,", len(uncached), "decoded")
+            cached_rows = {image_id: row for (image_id, _, _), row
+                           in zip(cached, image_cache.store.rows([image_id for image_id, _, _ in cached]))}
+            # Taken once, the writer thread replaces the memory map as it adds images
+            cached_images = image_cache.store.array
+
+        if batches and self.encoder is None:
+            self.extract_image_features()
+
+        def decoded_batches(executor):
+            def submit(batch):
+                return [executor.submit(lambda row: cached_images[row][..., ::-1], cached_rows[image_id])
+                        if image_id in cached_rows else executor.submit(self.read_image, image_path)
+                        for image_id, image_path, _ in batch]
+
+            decoding = submit(batches[0]) if batches else []
+            for b in range(len(batches)):
+                images = [future.result() for future in decoding]
+                # Start decoding the next batch while this one is encoded
+                if b + 1 < len(batches):
+                    decoding = submit(batches[b + 1])
+
+                # Skip the images that couldn't be loaded
+                loaded = [(image_id, content_hash) for (image_id, _, content_hash), img in zip(batches[b], images)
+                          if img is not None]
+                images = [img for img in images if img is not None]
+                if not images:
+                    continue
+                decoded = [(image_id, content_hash, img[..., ::-1]) for (image_id, content_hash), img in zip(loaded, images)
+                           if image_id not in cached_rows]
+                if decoded:
+                    decoded = ([image_id for image_id, _, _ in decoded], [content_hash for _, content_hash, _ in decoded],
+                               np.stack([img for _, _, img in decoded]))
+                yield ([image_id for image_id, _ in loaded], [content_hash for _, content_hash in loaded], images,
+                       decoded or None)
+
+        def extract(image_ids, content_hashes, images):
+            image = np.zeros((batch_size, 224, 224, 3), dtype=np.float32)
+            image[:len(images)] = images
             image = preprocess_input(image)
-            feature = self.encoder.predict(image, verbose=0)
-            image_id = file.split('.')[0]
-            features[image_id] = feature
+            return image_ids, content_hashes, self.encoder.predict_on_batch(image)[:len(images)]
 
+        with ThreadPoolExecutor(max_workers=num_workers or os.cpu_count()) as executor:
+            run_extraction(decoded_batches(executor), [("VGG16", cache, extract)], image_cache, max_pending_writes,
+                           len(batches), len(pending))
         self.features = features
 
 
@@ -117,28 +232,12 @@ class ImageCaptionGenerator:
         - file_to_access: file name to be accessed for the captions to be generated
 
         Explanation:
-        This function extracts the captions from the captions zip file in the dataset
-        and saves in a variable called mapping
+        This function streams the captions from the captions zip file in the dataset
+        into a compact caption index, saved in a variable called caption_index, and
+        builds the variable called mapping from it
         """
-        with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-            with zip_ref.open(file_to_access) as file:
-                content = file.read().decode('utf-8')
-    
-                # return(content)
-
-        mapping = {}
-        for line in tqdm(content.split('\n')):
-            tokens = line.split(',')
-            if len(line) < 2:
-                continue
-            image_id, caption = tokens[0], tokens[1:]
-            image_id = image_id.split('.')[0]
-            caption = " ".join(caption)
-            if image_id not in mapping:
-                mapping[image_id] = []
-            mapping[image_id].append(caption)
-
-        self.mapping = mapping
+        self.caption_index = CaptionIndex.from_zip(zip_file_path, file_to_access, file_format='csv')
+        self.mapping = self.caption_index.captions_by_image()
 
 #-----------------------------------------------------------------
 #-----------------------------------------------------------------
@@ -174,47 +273,207 @@ class ImageCaptionGenerator:
         # Add the start sequence token to the word index
         tokenizer.word_index['startseq'] = len(tokenizer.word_index) + 1
         tokenizer.word_index['endseq'] = len(tokenizer.word_index) + 1
+        self.set_tokenizer(tokenizer)
+
+    def set_tokenizer(self, tokenizer):
+        """
+        This function sets the tokenizer (or a Vocabulary with the same word ids)
+        and the id-to-word array used for decoding
+        """
         self.tokenizer = tokenizer
         self.vocab_size = len(tokenizer.word_index) + 1
 
+        # Array of words indexed by word id, index 0 (padding) has no word
+        self.index_word = np.empty(self.vocab_size, dtype=object)
+        for word, idx in tokenizer.word_index.items():
+            self.index_word[idx] = word
+
 #-----------------------------------------------------------------
 #-----------------------------------------------------------------
 
-    def create_sequences(self):
+    def create_caption_matrix(self):
         """
-        This function provides padded sequences
+        This function provides one padded token row per caption
 
         Arguments:
         - self: ImageCaptionGenerator class variables
+
+        Explanation:
+        Every caption is converted to a sequence of integers and padded at the end
+        to the length of the longest caption. The feature store row of the image
+        is kept alongside, so each image feature is stored only once
         """
-        sequences = []
+        sequences, image_rows = [], []
         for key, captions in self.mapping.items():
+            image_row = self.features.row(key)
             for caption in captions:
                 # Convert caption to sequence of integers
-                sequence = self.tokenizer.texts_to_sequences([caption])[0]
-                # Generate multiple input-output pairs for the sequence
-                for i in range(1, len(sequence)):
-                    in_seq, out_seq = sequence[:i], sequence[i]
-                    in_seq = pad_sequences([in_seq], maxlen=self.max_length)[0]
-                    out_seq = to_categorical([out_seq], num_classes=self.vocab_size)[0]
-                    sequences.append((key, in_seq, out_seq))
+                sequences.append(self.tokenizer.texts_to_sequences([caption])[0])
+                image_rows.append(image_row)
+
+        tokens = pad_sequences(sequences, padding='post').astype(np.int32)
+        return tokens, np.array(image_rows, dtype=np.int32)
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
 
-        return sequences
+    def prepare_captions(self, cache_dir="datasets/captions"):
+        """
+        This function provides the vocabulary and the caption matrix
+
+        Arguments:
+        - self: ImageCaptionGenerator class variables
+        - cache_dir: folder of the tokenized caption cache
+
+        Explanation:
+        Runs clean_captions, create_tokenizer and create_caption_matrix, and
+        saves the vocabulary and the token rows keyed by the caption file and
+        the cleaning rules. When they are unchanged, the saved arrays are loaded
+        instead and no caption is cleaned or tokenized. The image of every
+        caption is kept by name, so the rows follow the current feature store
+        """
+        cache = CaptionCache(cache_dir, 'baseline')
+        fingerprint = cache.fingerprint(self.caption_index, self.CLEANING_RULES)
+        cached = cache.load(fingerprint)
+        if cached is not None:
+            print("\t loading the cached vocabulary and caption matrix")
+            self.set_tokenizer(Vocabulary(cached['words'].tolist()))
+            image_ids = cached['image_ids'].tolist()
+            return cached['tokens'], self.features.rows(image_ids)[cached['image_index']].astype(np.int32)
+
+        print("\t cleaning the captions")
+        self.clean_captions()
+        print("\t tokenization and other preprocessing")
+        self.create_tokenizer()
+        tokens, image_rows = self.create_caption_matrix()
+
+        image_ids = list(self.mapping)
+        image_index = np.repeat(np.arange(len(image_ids), dtype=np.int32),
+                                [len(captions) for captions in self.mapping.values()])
+        words = sorted(self.tokenizer.word_index, key=self.tokenizer.word_index.get)
+        cache.save(fingerprint, words=np.array(words, dtype=str), tokens=tokens,
+                   image_index=image_index, image_ids=np.array(image_ids, dtype=str))
+        return tokens, image_rows
 
 #-----------------------------------------------------------------
 #-----------------------------------------------------------------
 
-    def generate_data(self, sequences):
-        X_image, X_sequence, y = [], [], []
-        for key, in_seq, out_seq in sequences:
-            # Retrieve image features
-            image_feature = self.features[key][0]
-            # Append the data to respective lists
-            X_image.append(image_feature)
-            X_sequence.append(in_seq)
-            y.append(out_seq)
+    def create_datasets(self, tokens, image_rows, batch_size, test_size=0.2, val_size=0.1, seed=42):
+        """
+        This function provides the streaming train, validation and test datasets
+
+        Arguments:
+        - self: ImageCaptionGenerator class variables
+        - tokens: padded token rows from create_caption_matrix
+        - image_rows: feature store row of the image of every caption
+        - batch_size: number of (prefix, next word) pairs per batch
+        - test_size: fraction of the captions used for testing
+        - val_size: fraction of the remaining captions used for validation
+        - seed: seed of the split
 
-        return np.array(X_image), np.array(X_sequence), np.array(y)
+        Explanation:
+        The captions are split by index inside the pipeline. Each caption is then
+        expanded into its (prefix, next word) pairs, and the image features are
+        gathered by row from the memory-mapped feature store once a batch is
+        formed, so neither the whole store nor a per-prefix copy of the
+        features or the sequences is ever materialized
+        """
+        num_captions = len(tokens)
+        features = self.features.array
+        feature_shape = self.features.feature_shape
+        feature_dtype = tf.as_dtype(self.features.dtype)
+        tokens = tf.constant(tokens)
+        image_rows = tf.constant(image_rows)
+
+        def expand_prefixes(caption):
+            in_seqs, out_seqs = self.prefix_windows(tokens[caption])
+            rows = tf.fill([tf.shape(out_seqs)[0]], image_rows[caption])
+            return tf.data.Dataset.from_tensor_slices((rows, in_seqs, out_seqs))
+
+        def gather_features(rows, in_seqs, out_seqs):
+            batch_features = tf.numpy_function(lambda rows: features[rows], [rows], feature_dtype)
+            return (tf.ensure_shape(batch_features, (None,) + feature_shape), in_seqs), out_seqs
+
+        def prefix_dataset(captions, shuffle):
+            if shuffle:
+                captions = captions.shuffle(num_captions)
+            dataset = captions.flat_map(expand_prefixes)
+            if shuffle:
+                # Only row indices and token ids are buffered here, not features
+                dataset = dataset.shuffle(batch_size * 8)
+            dataset = dataset.batch(batch_size).map(gather_features, num_parallel_calls=tf.data.AUTOTUNE)
+            return dataset.prefetch(tf.data.AUTOTUNE)
+
+        num_test = int(num_captions * test_size)
+        num_val = int((num_captions - num_test) * val_size)
+        captions = tf.data.Dataset.range(num_captions).shuffle(num_captions, seed=seed, reshuffle_each_iteration=False)
+
+        test_dataset = prefix_dataset(captions.take(num_test), shuffle=False)
+        val_dataset = prefix_dataset(captions.skip(num_test).take(num_val), shuffle=False)
+        train_dataset = prefix_dataset(captions.skip(num_test + num_val), shuffle=True)
+        return train_dataset, val_dataset, test_dataset
+
+    def prefix_windows(self, sequence):
+        """
+        Returns the (prefix, next word) pairs of a post-padded caption
+
+        Left padding makes every prefix a window of max_length tokens
+        """
+        max_length = self.max_length
+        length = tf.math.count_nonzero(sequence, dtype=tf.int32)
+        padded = tf.concat([tf.zeros([max_length], tf.int32), sequence], axis=0)
+        positions = tf.range(1, length)
+        in_seqs = tf.gather(padded, positions[:, None] + tf.range(max_length)[None, :])
+        out_seqs = tf.gather(sequence, positions)
+        return in_seqs, out_seqs
+
+    def create_shard_datasets(self, shard_reader, batch_size, test_size=0.2, val_size=0.1, seed=42):
+        """
+        This function provides the streaming datasets from TFRecord shards
+
+        Arguments:
+        - self: ImageCaptionGenerator class variables
+        - shard_reader: ShardReader of the shards written by pack_shards
+        - batch_size: number of (prefix, next word) pairs per batch
+        - test_size: fraction of the images used for testing
+        - val_size: fraction of the remaining images used for validation
+        - seed: seed of the split
+
+        Explanation:
+        Same batches as create_datasets, but every record already holds the
+        VGG16 feature and the captions of an image, so nothing is gathered
+        from the feature store. The split is made by a hash of the image id,
+        so all the captions of an image fall in the same set without any
+        list of the split being kept. The shards are read interleaved, and in
+        a new order every epoch for training
+        """
+        test_buckets = int(1000 * test_size)
+        val_buckets = test_buckets + int((1000 - test_buckets) * val_size)
+
+        def in_split(first, last):
+            def predicate(image_id, features, captions):
+                bucket = tf.strings.to_hash_bucket_strong(image_id, 1000, [seed, seed])
+                return (bucket >= first) & (bucket < last)
+            return predicate
+
+        def expand_prefixes(features, sequence):
+            in_seqs, out_seqs = self.prefix_windows(sequence)
+            image_features = tf.repeat(features[tf.newaxis], tf.shape(out_seqs)[0], axis=0)
+            return tf.data.Dataset.from_tensor_slices(((image_features, in_seqs), out_seqs))
+
+        def prefix_dataset(first, last, shuffle):
+            dataset = shard_reader.dataset(shuffle=shuffle).filter(in_split(first, last))
+            dataset = dataset.flat_map(lambda image_id, features, captions: tf.data.Dataset.from_tensor_slices(
+                (tf.repeat(features[tf.newaxis], tf.shape(captions)[0], axis=0), captions)))
+            dataset = dataset.flat_map(expand_prefixes)
+            if shuffle:
+                dataset = dataset.shuffle(batch_size * 8)
+            return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+        test_dataset = prefix_dataset(0, test_buckets, shuffle=False)
+        val_dataset = prefix_dataset(test_buckets, val_buckets, shuffle=False)
+        train_dataset = prefix_dataset(val_buckets, 1000, shuffle=True)
+        return train_dataset, val_dataset, test_dataset
 
 #-----------------------------------------------------------------
 #-----------------------------------------------------------------
@@ -225,6 +484,13 @@ class ImageCaptionGenerator:
 
         Arguments:
         - self: ImageCaptionGenerator class variables
+
+        Explanation:
+        Besides the decoder used for training, two inference models are built on
+        the same layers, so they always use the trained weights: image_projection
+        maps an image feature through the image branch once per caption, and
+        step_decoder runs one LSTM step on a single word id and the previous
+        LSTM state, returning the next word distribution and the new state
         """
         # Image feature input
         inputs1 = Input(shape=(4096,))
@@ -233,28 +499,46 @@ class ImageCaptionGenerator:
 
         # Sequence input
         inputs2 = Input(shape=(self.max_length,))
-        y1 = Embedding(self.vocab_size, 256, mask_zero=True)(inputs2)
+        embedding = Embedding(self.vocab_size, 256, mask_zero=True)
+        y1 = embedding(inputs2)
         y2 = Dropout(0.4)(y1)
-        y3 = LSTM(256)(y2)
+        lstm = LSTM(256)
+        y3 = lstm(y2)
 
         # Decoder model
         decoder1 = add([x2, y3])
-        decoder2 = Dense(256, activation='relu')(decoder1)
-        outputs = Dense(self.vocab_size, activation='softmax')(decoder2)
+        dense = Dense(256, activation='relu')
+        decoder2 = dense(decoder1)
+        output_layer = Dense(self.vocab_size, activation='softmax')
+        outputs = output_layer(decoder2)
 
         # Merge the models
         model = Model(inputs=[inputs1, inputs2], outputs=outputs)
-        model.compile(loss='categorical_crossentropy', optimizer='adam')
+        # The targets are integer word ids, so the sparse loss is used
+        model.compile(loss='sparse_categorical_crossentropy', optimizer='adam')
 
         self.decoder = model
 
+        # Image branch only, computed once per image at inference
+        self.image_projection = Model(inputs=inputs1, outputs=x2)
+
+        # Single step decoder sharing the embedding, LSTM and dense layers
+        word_input = Input(shape=(), dtype='int32')
+        image_input = Input(shape=(256,))
+        state_h = Input(shape=(256,))
+        state_c = Input(shape=(256,))
+        word = embedding(word_input)
+        hidden, (next_h, next_c) = lstm.cell(word, [state_h, state_c])
+        step_outputs = output_layer(dense(add([image_input, hidden])))
+        self.step_decoder = Model(inputs=[word_input, image_input, state_h, state_c],
+                                  outputs=[step_outputs, next_h, next_c])
+
 #-----------------------------------------------------------------
 #-----------------------------------------------------------------
         
     def get_word_from_index(self, index):
-        for word, idx in self.tokenizer.word_index.items():
-            if idx == index:
-                return word
+        if 0 <= index < len(self.index_word):
+            return self.index_word[index]
         return None
 
 
@@ -267,41 +551,49 @@ class ImageCaptionGenerator:
         - self: ImageCaptionGenerator class variables
         - test_image_path: path for testing the image
         """
-        # Load the test image
-        img = cv2.imread(test_image_path)
+        # Load the test image, decoded like the training images
+        img = self.read_image(test_image_path)
         if img is None:
             print(f"Failed to load the test image from path: {test_image_path}")
             return
 
         # Preprocess the test image
-        target_size = (224, 224)
-        img = cv2.resize(img, target_size)
         image = img_to_array(img)
         image = image.reshape((1, image.shape[0], image.shape[1], image.shape[2]))
         image = preprocess_input(image)
 
         # Generate image features using the pre-trained model
+        if self.encoder is None:
+            self.extract_image_features()
         test_image_feature = self.encoder.predict(image, verbose=0)
 
         # Generate a caption for the test image
         start_token = self.tokenizer.word_index['startseq']
         end_token = self.tokenizer.word_index['endseq']
-        caption = 'startseq'
+        # Word ids are generated into a preallocated array and only
+        # converted to words once the caption is complete
+        caption_ids = np.zeros(self.max_length + 1, dtype=np.int32)
+        caption_ids[0] = start_token
+        length = 1
+
+        # The LSTM state carries the prefix, so each word costs a single LSTM step
+        image_projection = self.image_projection(test_image_feature, training=False)
+        state_h = tf.zeros((1, 256))
+        state_c = tf.zeros((1, 256))
         for _ in range(self.max_length):
-            sequence = self.tokenizer.texts_to_sequences([caption])[0]
-            sequence = pad_sequences([sequence], maxlen=self.max_length)
-
-            # Modify the code to include the sequence tensor
-            yhat = self.decoder.predict([test_image_feature, sequence], verbose=0)
+            word = tf.constant(caption_ids[length - 1:length])
+            yhat, state_h, state_c = self.step_decoder([word, image_projection, state_h, state_c], training=False)
 
             yhat = np.argmax(yhat)
-            word = self.get_word_from_index(yhat)
-            if word is None:
+            if self.get_word_from_index(yhat) is None:
                 break
-            caption += ' ' + word
+            caption_ids[length] = yhat
+            length += 1
             if yhat == end_token:
                 break
 
+        caption = ' '.join(self.index_word[caption_ids[:length]])
+
         # Print the generated caption
         print("Generated Caption:", caption)
 
@@ -335,36 +627,57 @@ class ImageCaptionGenerator:
 # Instantiate the ImageCaptionGenerator
 generator = ImageCaptionGenerator()
 
-print("Loading VGG16 model")
-generator.extract_image_features()
+# JPEG_DCT_SCALING, IMAGE_CROP and IMAGE_RESIZE_METHOD set up the decoding, see ImageDecoder.from_env
+generator.image_decoder = ImageDecoder.from_env((224, 224))
+# SHARED_DECODE=1 uses the features of DualExtraction.py, the 224x224 images
+# are then resized from the 299x299 decode of the attention model
+if os.environ.get('SHARED_DECODE', '0') == '1':
+    generator.shared_decoder = ImageDecoder.from_env((299, 299))
 
-print("Extracting image features")
-generator.load_image_features("datasets/Flicker8k_Dataset")
+# IMAGE_SOURCE can point to the image folder or to the zip file, see default_image_source
+image_source = default_image_source()
+
+# BENCHMARK_DECODE=1 reports the decode cost per megapixel of the first images
+if os.environ.get('BENCHMARK_DECODE', '0') == '1':
+    benchmark_images = [image_source.name(image_id) for image_id in image_source.image_ids()[:200]]
+    for path, cost in benchmark_decode(benchmark_images, (224, 224), generator.image_decoder.resize_method,
+                                       read=image_source.read).items():
+        print(f"\t Decode {path}: {cost:.2f} ms per megapixel")
+
+# IMAGE_CACHE_MB=<budget> keeps the decoded 224x224 images, so extracting with another backbone skips the decoding
+image_cache_bytes = int(float(os.environ.get('IMAGE_CACHE_MB', 0)) * (1 << 20))
+image_cache = ImageCache("datasets/images", generator.image_config(), image_cache_bytes) if image_cache_bytes else None
+
+print("Extracting image features, VGG16 is loaded only for new or changed images")
+extract_batch_size = int(os.environ.get('EXTRACT_BATCH_SIZE', 32))
+generator.load_image_features(image_source, batch_size=extract_batch_size, image_cache=image_cache)
 
 print("Loading captions data from the dataset file")
 generator.load_captions_data("datasets/download_ds_file.zip","Flickr8k.token.txt")
 
 print("Preprocessing the captions")
-generator.clean_captions()
-
-print("\t tokenization and other preprocessing") 
-generator.create_tokenizer()
+# Create one padded token row per caption, or load them from the caption cache
+tokens, image_rows = generator.prepare_captions()
 
 # Set the maximum length for sequences
 generator.max_length = 20
 
-# Create sequences from the captions
-sequences = generator.create_sequences()
-
-# Generate data for model training
-X_image, X_sequence, y = generator.generate_data(sequences)
+# Convert epoch number and batch size to integers
+epoch_number = int(os.environ.get('EPOCH_NUMBER'))
+batch_size = int(os.environ.get('BATCH_SIZE'))
 
-# Split the data into train, test, and validation sets
+# Split the captions into train, test, and validation sets
 print("Splitting the data into train, test, and validation sets")
-X_image_train, X_image_test, X_sequence_train, X_sequence_test, y_train, y_test = train_test_split(
-    X_image, X_sequence, y, test_size=0.2, random_state=42)
-X_image_train, X_image_val, X_sequence_train, X_sequence_val, y_train, y_val = train_test_split(
-    X_image_train, X_sequence_train, y_train, test_size=0.1, random_state=42)
+# TFRECORD_DIR=<folder> packs the features and captions into TFRecord shards, once, and trains from them
+shard_dir = os.environ.get('TFRECORD_DIR')
+if shard_dir:
+    words = sorted(generator.tokenizer.word_index, key=generator.tokenizer.word_index.get)
+    shard_reader = pack_shards(os.path.join(shard_dir, "baseline"), generator.features.row_ids, image_rows, tokens,
+                               words=words, store=generator.features)
+    print(f"\t Training from {len(shard_reader.files)} shards, {shard_reader.nbytes() / (1 << 20):.0f} MB")
+    train_dataset, val_dataset, test_dataset = generator.create_shard_datasets(shard_reader, batch_size)
+else:
+    train_dataset, val_dataset, test_dataset = generator.create_datasets(tokens, image_rows, batch_size)
 
 # Define the model
 generator.define_model()
@@ -372,26 +685,22 @@ generator.define_model()
 # Train the model using the generated data
 print("Training the model:")
 
-# Convert epoch number and batch size to integers
-epoch_number = int(os.environ.get('EPOCH_NUMBER'))
-batch_size = int(os.environ.get('BATCH_SIZE'))
-
 print("\t Epoch number:", epoch_number)
 print("\t Batch number:", batch_size)
 
-generator.decoder.fit([X_image_train, X_sequence_train], y_train, 
-                    validation_data=([X_image_val, X_sequence_val], y_val),
-                    epochs=epoch_number, batch_size=batch_size,verbose=1)
+generator.decoder.fit(train_dataset, validation_data=val_dataset,
+                    epochs=epoch_number, verbose=1)
 
 print("Model trained for the specified number of epochs and batch size")
 
 # Evaluate the model on the test set
 print("Evaluating the model on the test set")
 
-test_loss = generator.decoder.evaluate([X_image_test, X_sequence_test], y_test, verbose=1)
+test_loss = generator.decoder.evaluate(test_dataset, verbose=1)
 print("Test Loss:", test_loss)
 
 
 
 # Evaluate the model on a test image
-generator.evaluate_model("datasets/Flicker8k_Dataset/1001773457_577c3a7d70.jpg")
+generator.evaluate_model(image_source.name("1001773457_577c3a7d70"))
+image_source.close()
@@ -0,0 +1,538 @@
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+import os
+import re
+import json
+import zipfile
+import hashlib
+from array import array
+from collections import Counter, namedtuple
+from multiprocessing import Pool
+import numpy as np
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+# Result of CaptionEncoder.encode
+# - tokens: int32 matrix with one post-padded row of word ids per caption
+# - lengths: number of word ids in each row
+# - image_index: row of the caption's image in image_ids
+# - image_ids: image names, in order of first appearance
+EncodedCaptions = namedtuple('EncodedCaptions', ['tokens', 'lengths', 'image_index', 'image_ids'])
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Version of the cleaning rules of clean_words, to be bumped whenever they change
+CLEANING_RULES = 'clean_words-1'
+
+# Version of the layout of the CaptionCache files
+CACHE_FORMAT = 1
+
+
+def clean_words(caption):
+    """
+    Same rules as captions_clean: lowercase, split on anything which is not a
+    letter or a digit, and keep the words longer than one character which
+    contain only alphabets
+    """
+    return [word for word in WORD_PATTERN.findall(caption.lower()) if len(word) > 1 and word.isalpha()]
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+class CaptionIndex:
+
+
+    def __init__(self, file_format='token'):
+        """
+        Compact caption index
+
+        Arguments:
+        - self: CaptionIndex class variables
+        - file_format: 'token' for the '<image>.jpg#<idx>\t<caption>' lines of
+          Flickr8k.token.txt, 'csv' for the '<image>.jpg,<caption>' lines read
+          by the Baseline load_captions_data
+
+        Explanation:
+        Instead of a dictionary of Python string lists, the captions are kept as
+        one contiguous UTF-8 buffer with an offsets array, every caption being
+        buffer[offsets[i]:offsets[i + 1]]. Image names are interned into a table
+        and caption_image holds the table row of the image of every caption.
+        The index can be used like the image_dict dictionary:
+        index[image_name] returns the list of captions of that image
+        """
+        self.file_format = file_format
+        self.image_ids = []
+        self.image_row = {}
+        self.caption_image = array('i')
+        self.offsets = array('q', [0])
+        self.buffer = bytearray()
+        self.fingerprint = None
+        self._image_captions = None
+
+    def __len__(self):
+        return len(self.caption_image)
+
+    def __contains__(self, image_id):
+        return image_id in self.image_row
+
+    def __getitem__(self, image_id):
+        return [self.caption(i) for i in self.captions_of(self.image_row[image_id])]
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    @classmethod
+    def from_zip(cls, zip_file_path, file_to_access, file_format='token', chunk_size=1 << 20):
+        """
+        This function builds the index from a caption file inside a zip file
+
+        Arguments:
+        - zip_file_path: path of the zip file
+        - file_to_access: name of the caption file in the zip file
+        - file_format: 'token' or 'csv', see __init__
+        - chunk_size: number of bytes read from the zip member at a time
+
+        Explanation:
+        The member is read in chunks and parsed line by line as it streams in,
+        so the whole file is never held in memory. A SHA-1 of the file content
+        is kept in fingerprint
+        """
+        index = cls(file_format)
+        digest = hashlib.sha1()
+        with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+            with zip_ref.open(file_to_access) as file:
+                for line in iter_lines(file, chunk_size, digest):
+                    index.add_line(line)
+        index.fingerprint = digest.hexdigest()
+        return index
+
+    @classmethod
+    def from_bytes(cls, content, file_format='token'):
+        """
+        This function builds the index from the content of a caption file
+        """
+        index = cls(file_format)
+        for line in content.split(b'\n'):
+            index.add_line(line)
+        index.fingerprint = hashlib.sha1(content).hexdigest()
+        return index
+
+    def add_line(self, line):
+        """
+        This function adds one line of the caption file to the index
+        """
+        if self.file_format == 'csv':
+            # Same parsing as load_captions_data, minus the 'image,caption' header
+            tokens = line.split(b',')
+            if len(line) < 2 or line == b'image,caption':
+                return
+            image_name, caption = tokens[0], b" ".join(tokens[1:])
+        else:
+            line_split = line.split(b'\t')
+            if len(line_split) != 2:
+                # Skip the blank lines of the dataset
+                return
+            image_name, caption = line_split
+            image_name = image_name.split(b'#')[0]
+        image_name = image_name.split(b'.')[0].decode('utf-8')
+
+        row = self.image_row.get(image_name)
+        if row is None:
+            row = self.image_row[image_name] = len(self.image_ids)
+            self.image_ids.append(image_name)
+        self.caption_image.append(row)
+        self.buffer += caption
+        self.offsets.append(len(self.buffer))
+        self._image_captions = None
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def caption(self, i):
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def captions_of(self, image_row):
+        """
+        Returns the indices of the captions of an image table row
+        """
+        if self._image_captions is None:
+            caption_image = np.frombuffer(self.caption_image, dtype=np.int32)
+            order = np.argsort(caption_image, kind='stable')
+            bounds = np.searchsorted(caption_image[order], np.arange(len(self.image_ids) + 1))
+            self._image_captions = (order, bounds)
+        order, bounds = self._image_captions
+        return order[bounds[image_row]:bounds[image_row + 1]]
+
+    def captions_by_image(self):
+        """
+        Returns the {"image_name" : ["caption 1", "caption 2"]} dictionary
+        """
+        mapping = {}
+        for i, row in enumerate(self.caption_image):
+            mapping.setdefault(self.image_ids[row], []).append(self.caption(i))
+        return mapping
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def split_mask(self, zip_file_path, file_to_access, chunk_size=1 << 20):
+        """
+        This function reads an image split file into a boolean image mask
+
+        Arguments:
+        - self: CaptionIndex class variables
+        - zip_file_path: path of the zip file
+        - file_to_access: name of the split file, e.g. Flickr_8k.trainImages.txt
+
+        Explanation:
+        Returns a boolean array over the image table which is True for the
+        images listed in the split file. Listed images without captions are
+        ignored
+        """
+        mask = np.zeros(len(self.image_ids), dtype=bool)
+        with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+            with zip_ref.open(file_to_access) as file:
+                for line in iter_lines(file, chunk_size):
+                    row = self.image_row.get(line.split(b'.')[0].decode('utf-8'))
+                    if row is not None:
+                        mask[row] = True
+        return mask
+
+    def image_names(self, mask):
+        return [self.image_ids[row] for row in np.flatnonzero(mask)]
+
+    def caption_indices(self, mask=None):
+        """
+        Returns the indices of the captions of the images selected by the mask
+        """
+        if mask is None:
+            return np.arange(len(self))
+        return np.flatnonzero(mask[np.frombuffer(self.caption_image, dtype=np.int32)])
+
+
+def iter_lines(file, chunk_size, digest=None):
+    """
+    Yields the lines of a binary file object, reading chunk_size bytes at a time
+    """
+    remainder = b''
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        if digest is not None:
+            digest.update(chunk)
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        yield from lines
+    if remainder:
+        yield remainder
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+class CaptionCache:
+
+
+    def __init__(self, cache_dir, name):
+        """
+        Tokenized caption cache
+
+        Arguments:
+        - self: CaptionCache class variables
+        - cache_dir: folder of the cache files
+        - name: name of the cached artifact, e.g. 'attention'
+
+        Explanation:
+        Keeps the fitted vocabulary and the encoded caption arrays of a run in
+        an uncompressed npz file named after a fingerprint of everything they
+        were computed from: the caption file content, the cleaning rules, the
+        split lists and the encoding parameters. A later run with the same
+        fingerprint loads the arrays instead of preprocessing the text again.
+        Files of the same name with another fingerprint are deleted on save
+        """
+        self.cache_dir = cache_dir
+        self.name = name
+
+    def fingerprint(self, index, cleaning_rules, masks=(), **params):
+        """
+        This function computes the key of the cached arrays
+
+        Arguments:
+        - self: CaptionCache class variables
+        - index: CaptionIndex of the caption file
+        - cleaning_rules: version string of the cleaning rules
+        - masks: boolean image masks of the splits the arrays depend on
+        - params: any other setting the arrays depend on, e.g. the tokens
+
+        Explanation:
+        Splits are keyed by the names of the images they select, so a mask
+        keeps its key as long as the same images are selected
+        """
+        splits = [hashlib.sha1('\n'.join(index.image_names(mask)).encode('utf-8')).hexdigest()
+                  for mask in masks]
+        key = {'format': CACHE_FORMAT,
+               'captions': index.fingerprint,
+               'file_format': index.file_format,
+               'cleaning_rules': cleaning_rules,
+               'splits': splits,
+               'params': params}
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    def path(self, fingerprint):
+        return os.path.join(self.cache_dir, self.name + '-' + fingerprint + '.npz')
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def load(self, fingerprint):
+        """
+        Returns the dictionary of cached arrays, or None if there is no
+        usable cache file for the fingerprint
+        """
+        path = self.path(fingerprint)
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as file:
+            if 'format' not in file.files or int(file['format']) != CACHE_FORMAT:
+                return None
+            return {key: file[key] for key in file.files if key != 'format'}
+
+    def save(self, fingerprint, **arrays):
+        """
+        This function writes the arrays of the fingerprint
+
+        The file is written next to its final path and renamed, so an
+        interrupted run never leaves a truncated cache behind
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(fingerprint)
+        with open(path + '.tmp', 'wb') as file:
+            np.savez(file, format=np.array(CACHE_FORMAT), **arrays)
+        os.replace(path + '.tmp', path)
+
+        stale_pattern = re.compile(re.escape(self.name) + r'-[0-9a-f]{16}\.npz')
+        for file_name in os.listdir(self.cache_dir):
+            stale_path = os.path.join(self.cache_dir, file_name)
+            if stale_pattern.fullmatch(file_name) and stale_path != path:
+                os.remove(stale_path)
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+class Vocabulary:
+
+
+    def __init__(self, words):
+        """
+        Frozen vocabulary
+
+        Arguments:
+        - self: Vocabulary class variables
+        - words: list of words, ordered by word id starting from 1
+
+        Explanation:
+        Word id 0 is kept for padding. word_index and index_word mirror the
+        Keras Tokenizer attributes, so the vocabulary can be used wherever the
+        fitted tokenizer was used
+        """
+        self.words = list(words)
+        self.word_index = {word: idx + 1 for idx, word in enumerate(self.words)}
+        self.index_word = {idx + 1: word for idx, word in enumerate(self.words)}
+
+    def __len__(self):
+        return len(self.words)
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+# Vocabulary of the multiprocessing workers, set once per worker process
+_worker_state = {}
+
+
+def _init_worker(word_index, start_token, end_token):
+    _worker_state['word_index'] = word_index
+    _worker_state['start_token'] = start_token
+    _worker_state['end_token'] = end_token
+
+
+def _encode_captions(captions):
+    return _encode_captions_with(captions, _worker_state['word_index'],
+                                 _worker_state['start_token'], _worker_state['end_token'])
+
+
+def _encode_captions_with(captions, word_index, start_token, end_token):
+    """
+    Cleans and encodes the captions in a single pass
+
+    Returns the flat word ids of every caption and the number of ids of each
+    caption
+    """
+    flat_ids = array('i')
+    lengths = array('i')
+    start_id = word_index.get(start_token)
+    end_id = word_index.get(end_token)
+    for caption in captions:
+        length = len(flat_ids)
+        if start_id is not None:
+            flat_ids.append(start_id)
+        # Words outside of the vocabulary are dropped, as texts_to_sequences does
+        flat_ids.extend([word_index[word] for word in clean_words(caption) if word in word_index])
+        if end_id is not None:
+            flat_ids.append(end_id)
+        lengths.append(len(flat_ids) - length)
+
+    return flat_ids, lengths
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+class CaptionEncoder:
+
+
+    def __init__(self, start_token='startseq', end_token='endseq', num_workers=0, chunk_size=20000):
+        """
+        Caption preprocessing engine
+
+        Arguments:
+        - self: CaptionEncoder class variables
+        - start_token: word added at the beginning of every caption
+        - end_token: word added at the end of every caption
+        - num_workers: number of worker processes, 0 encodes in this process
+        - chunk_size: number of captions handed to a worker at a time
+
+        Explanation:
+        Turns the captions of a CaptionIndex straight into an int32 caption
+        matrix. Cleaning, adding the start/end tokens, encoding and padding are
+        done in one pass over the captions, instead of one pass per step with a
+        Python list of strings in between
+        """
+        self.start_token = start_token
+        self.end_token = end_token
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def fit(self, index, mask=None):
+        """
+        This function builds the vocabulary
+
+        Arguments:
+        - self: CaptionEncoder class variables
+        - index: CaptionIndex of the caption file
+        - mask: boolean image mask of the images whose captions are used
+
+        Explanation:
+        Word ids are given by decreasing word count, ties in order of first
+        appearance, which is the same order the Keras Tokenizer uses
+        """
+        word_counts = Counter()
+        for i in index.caption_indices(mask):
+            word_counts[self.start_token] += 1
+            word_counts.update(clean_words(index.caption(i)))
+            word_counts[self.end_token] += 1
+
+        words = sorted(word_counts.items(), key=lambda item: item[1], reverse=True)
+        return Vocabulary([word for word, count in words])
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def encode(self, index, vocabulary, mask=None, max_length=None):
+        """
+        This function encodes the captions into an int32 matrix
+
+        Arguments:
+        - self: CaptionEncoder class variables
+        - index: CaptionIndex of the caption file
+        - vocabulary: frozen Vocabulary (or fitted tokenizer) used for the word ids
+        - mask: boolean image mask of the images whose captions are encoded
+        - max_length: width of the matrix, defaults to the longest caption
+
+        Explanation:
+        Returns EncodedCaptions. Rows are padded at the end like pad_text does,
+        and captions longer than max_length keep their last max_length ids, the
+        default truncation of pad_sequences
+        """
+        selected = index.caption_indices(mask)
+        captions = [index.caption(i) for i in selected]
+        if self.num_workers > 1:
+            chunks = [captions[i:i + self.chunk_size] for i in range(0, len(captions), self.chunk_size)]
+            with Pool(self.num_workers, initializer=_init_worker,
+                      initargs=(vocabulary.word_index, self.start_token, self.end_token)) as pool:
+                results = pool.map(_encode_captions, chunks)
+        else:
+            results = [_encode_captions_with(captions, vocabulary.word_index, self.start_token, self.end_token)]
+
+        flat_ids = np.concatenate([np.frombuffer(ids, dtype=np.int32) for ids, _ in results] or [np.zeros(0, np.int32)])
+        lengths = np.concatenate([np.frombuffer(lens, dtype=np.int32) for _, lens in results] or [np.zeros(0, np.int32)])
+
+        # Image table rows come in order of first appearance, so do the image ids
+        image_rows, image_index = np.unique(np.frombuffer(index.caption_image, dtype=np.int32)[selected],
+                                            return_inverse=True)
+
+        if max_length is None:
+            max_length = int(lengths.max()) if len(lengths) else 0
+
+        # Scatter the flat ids into the preallocated matrix
+        num_captions = len(lengths)
+        tokens = np.zeros((num_captions, max_length), dtype=np.int32)
+        caption_of_id = np.repeat(np.arange(num_captions), lengths)
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        position = np.arange(len(flat_ids)) - np.repeat(starts, lengths)
+        column = position - np.repeat(np.maximum(lengths - max_length, 0), lengths)
+        keep = column >= 0
+        tokens[caption_of_id[keep], column[keep]] = flat_ids[keep]
+
+        return EncodedCaptions(tokens, np.minimum(lengths, max_length).astype(np.int32),
+                               image_index.astype(np.int32), [index.image_ids[row] for row in image_rows])
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def fit_encode(self, index, fit_mask=None, encode_mask=None, max_length=None, cache=None):
+        """
+        This function builds the vocabulary and encodes the captions
+
+        Arguments:
+        - self: CaptionEncoder class variables
+        - index: CaptionIndex of the caption file
+        - fit_mask: boolean image mask of the images the vocabulary is built on
+        - encode_mask: boolean image mask of the images whose captions are encoded
+        - max_length: width of the matrix, defaults to the longest caption
+        - cache: optional CaptionCache the results are loaded from and saved to
+
+        Explanation:
+        Returns the Vocabulary and the EncodedCaptions of fit and encode. When
+        the cache holds arrays for the same caption file, cleaning rules,
+        splits and encoding settings, no caption is cleaned or encoded
+        """
+        if cache is not None:
+            masks = [np.ones(len(index.image_ids), dtype=bool) if mask is None else mask
+                     for mask in (fit_mask, encode_mask)]
+            fingerprint = cache.fingerprint(index, CLEANING_RULES, masks, start_token=self.start_token,
+                                            end_token=self.end_token, max_length=max_length)
+            cached = cache.load(fingerprint)
+            if cached is not None:
+                return (Vocabulary(cached['words'].tolist()),
+                        EncodedCaptions(cached['tokens'], cached['lengths'], cached['image_index'],
+                                        cached['image_ids'].tolist()))
+
+        vocabulary = self.fit(index, fit_mask)
+        encoded = self.encode(index, vocabulary, encode_mask, max_length)
+
+        if cache is not None:
+            cache.save(fingerprint, words=np.array(vocabulary.words, dtype=str), tokens=encoded.tokens,
+                       lengths=encoded.lengths, image_index=encoded.image_index,
+                       image_ids=np.array(encoded.image_ids, dtype=str))
+        return vocabulary, encoded
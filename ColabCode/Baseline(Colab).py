@@ -260,10 +260,8 @@ model.save(WORKING_DIR+'/best_model.h5')
 """
 
 def idx_to_word(integer, tokenizer):
-    for word, index in tokenizer.word_index.items():
-        if index == integer:
-            return word
-    return None
+    # index_word is the reverse of word_index, built once by fit_on_texts
+    return tokenizer.index_word.get(integer)
 
 # generate caption for an image
 def predict_caption(model, image, tokenizer, max_length):
@@ -0,0 +1,175 @@
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+import os
+import numpy as np
+import tensorflow as tf
+
+from Backbones import (INCEPTION_V3_FEATURE_SHAPE, VGG16_FEATURE_SHAPE, build_inception_v3, build_vgg16,
+                       inception_v3_config, run_extraction, vgg16_config)
+from FeatureStore import ExtractionCache
+from ImagePreprocessing import ImageDecoder, to_uint8_tf
+from ImageSource import default_image_source
+from CaptionPreprocessing import CaptionIndex
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+
+class DualExtractor:
+
+
+    def __init__(self, image_decoder, vgg16_size=(224, 224)):
+        """
+        Single pass feature extraction for both models
+
+        Arguments:
+        - self: DualExtractor class variables
+        - image_decoder: ImageDecoder of the 299x299 InceptionV3 images
+        - vgg16_size: (height, width) of the VGG16 images
+
+        Explanation:
+        Every image is read and decoded once. The decoded image is resized
+        to 299x299 for InceptionV3, exactly like AttentionModel.py does, and
+        to 224x224 for VGG16. Both are rounded to uint8, the VGG16 images are put
+        in BGR order, like the OpenCV images of BaselineModel.py, and are
+        keyed by image_decoder.shared_config, which BaselineModel.py uses with
+        SHARED_DECODE=1. Both backbones run on the same batches and each
+        feature set is written to its own extraction cache by its own writer
+        thread, so a later run of either script finds its features there
+        """
+        self.image_decoder = image_decoder
+        self.vgg16_size = tuple(vgg16_size)
+        self.inception_v3 = None
+        self.vgg16 = None
+
+    def attention_config(self):
+        return inception_v3_config(self.image_decoder.config())
+
+    def baseline_config(self):
+        return vgg16_config(self.image_decoder.shared_config(self.vgg16_size))
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def load_images(self, image_path, image_source):
+        """
+        This function decodes an image once into its InceptionV3 and VGG16 inputs
+        """
+        img, vgg16_img = self.image_decoder.decode_sizes_tf(image_source.read_tf(image_path),
+                                                             [self.image_decoder.target_size, self.vgg16_size])
+        # Rounded to uint8 like the images of AttentionModel.load_image
+        img = tf.keras.applications.inception_v3.preprocess_input(tf.cast(to_uint8_tf(img), tf.float32))
+        # Same values as the BGR uint8 images of BaselineModel.read_image
+        vgg16_img = tf.cast(to_uint8_tf(vgg16_img)[..., ::-1], tf.float32)
+        vgg16_img = tf.keras.applications.vgg16.preprocess_input(vgg16_img)
+        return img, vgg16_img
+
+    def extract(self, image_source, attention_ids, baseline_ids, cache_dir="datasets/features", batch_size=16,
+                max_pending_writes=4):
+        """
+        This function extracts the features of both models in one pass
+
+        Arguments:
+        - self: DualExtractor class variables
+        - image_source: DirectoryImageSource or ZipImageSource the images are read from
+        - attention_ids: image ids the InceptionV3 features are extracted for
+        - baseline_ids: image ids the VGG16 features are extracted for
+        - cache_dir: folder of the feature extraction caches
+        - batch_size: number of images run through the backbones at once
+        - max_pending_writes: number of extracted batches which can wait for each writer thread
+
+        Explanation:
+        Only new or changed images are decoded, and each backbone only runs
+        on the images of a batch its cache misses. A backbone is only loaded
+        when it has something to extract. An image which can't be read or
+        decoded is skipped. The throughput of each stage is printed
+        """
+        attention_cache = ExtractionCache(cache_dir, self.attention_config(), INCEPTION_V3_FEATURE_SHAPE)
+        baseline_cache = ExtractionCache(cache_dir, self.baseline_config(), VGG16_FEATURE_SHAPE)
+
+        print("Hashing the images to find new or changed ones")
+        pending = {}
+        for cache, image_ids in ((attention_cache, attention_ids), (baseline_cache, baseline_ids)):
+            image_ids = [image_id for image_id in image_ids if image_id in image_source]
+            for image_id, image_path, content_hash in cache.pending(image_ids, [image_source.name(image_id) for image_id in image_ids],
+                                                                    image_source.content_hash):
+                pending.setdefault(image_id, [image_path, content_hash, False, False])[2 if cache is attention_cache else 3] = True
+        image_ids = sorted(pending)
+        print("\t", sum(pending[image_id][2] for image_id in image_ids), "InceptionV3 and",
+              sum(pending[image_id][3] for image_id in image_ids), "VGG16 features to extract from",
+              len(image_ids), "images")
+        if not image_ids:
+            return attention_cache.store, baseline_cache.store
+
+        if self.inception_v3 is None and any(pending[image_id][2] for image_id in image_ids):
+            self.inception_v3 = build_inception_v3()
+        if self.vgg16 is None and any(pending[image_id][3] for image_id in image_ids):
+            self.vgg16 = build_vgg16()
+
+        # The image id travels with its images, so a batch knows whose features it holds
+        image_dataset = tf.data.Dataset.from_tensor_slices((
+            tf.constant(image_ids, tf.string),
+            tf.constant([pending[image_id][0] for image_id in image_ids], tf.string),
+            np.array([pending[image_id][2] for image_id in image_ids]),
+            np.array([pending[image_id][3] for image_id in image_ids])))
+        image_dataset = image_dataset.map(lambda image_id, path, to_attention, to_baseline:
+                                          (image_id, *self.load_images(path, image_source), to_attention, to_baseline),
+                                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        # An image which can't be read or decoded is skipped, like BaselineModel.py does
+        image_dataset = image_dataset.ignore_errors()
+        image_dataset = image_dataset.batch(batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+
+        def batches():
+            for batch_ids, img, vgg16_img, to_attention, to_baseline in image_dataset:
+                batch_ids = [image_id.decode('utf-8') for image_id in batch_ids.numpy()]
+                yield (batch_ids, [pending[image_id][1] for image_id in batch_ids],
+                       (img, vgg16_img, to_attention.numpy(), to_baseline.numpy()), None)
+
+        def extract_attention(batch_ids, content_hashes, images):
+            img, _, to_attention, _ = images
+            if not to_attention.any():
+                return None
+            batch_features = self.inception_v3(tf.boolean_mask(img, to_attention))
+            # Copied to host memory, the model runs asynchronously on a GPU and is timed until it is done
+            batch_features = tf.reshape(batch_features, (batch_features.shape[0], -1, batch_features.shape[3])).numpy()
+            return ([image_id for image_id, keep in zip(batch_ids, to_attention) if keep],
+                    [content_hash for content_hash, keep in zip(content_hashes, to_attention) if keep], batch_features)
+
+        def extract_baseline(batch_ids, content_hashes, images):
+            _, vgg16_img, _, to_baseline = images
+            if not to_baseline.any():
+                return None
+            batch_features = self.vgg16.predict_on_batch(tf.boolean_mask(vgg16_img, to_baseline))
+            return ([image_id for image_id, keep in zip(batch_ids, to_baseline) if keep],
+                    [content_hash for content_hash, keep in zip(content_hashes, to_baseline) if keep], batch_features)
+
+        run_extraction(batches(), [("InceptionV3", attention_cache, extract_attention), ("VGG16", baseline_cache, extract_baseline)],
+                       max_pending_writes=max_pending_writes, num_batches=-(-len(image_ids) // batch_size), num_images=len(image_ids))
+        return attention_cache.store, baseline_cache.store
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+
+# JPEG_DCT_SCALING, IMAGE_CROP and IMAGE_RESIZE_METHOD must match the ones
+# AttentionModel.py and BaselineModel.py (with SHARED_DECODE=1) are run with
+image_decoder = ImageDecoder.from_env((299, 299))
+extractor = DualExtractor(image_decoder)
+
+print("Retrieving names of training images from text file")
+image_dict = CaptionIndex.from_zip("datasets/download_ds_file.zip","Flickr8k.token.txt")
+training_mask = image_dict.split_mask("datasets/download_ds_file.zip","Flickr_8k.trainImages.txt")
+
+print("Opening the images:")
+# IMAGE_SOURCE can point to the image folder or to the zip file, see default_image_source
+image_source = default_image_source()
+print("\t", len(image_source.image_ids()), "images in", type(image_source).__name__)
+
+# The attention model is trained on the training images, the baseline model on all of them
+extractor.extract(image_source, sorted(set(image_dict.image_names(training_mask))), image_source.image_ids(),
+                  batch_size=int(os.environ.get('EXTRACT_BATCH_SIZE', 16)))
+image_source.close()
@@ -0,0 +1,605 @@
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+import os
+import json
+import re
+import time
+import queue
+import hashlib
+import threading
+import numpy as np
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+
+class FeatureStore:
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def __init__(self, store_path, feature_shape, dtype='float32'):
+        """
+        Feature store initialization
+
+        Arguments:
+        - self: FeatureStore class variables
+        - store_path: path prefix of the store, '.dat', '.ids' and '.json' are appended to it
+        - feature_shape: shape of a single image feature, e.g. (64, 2048)
+        - dtype: numpy data type of the stored features
+
+        Explanation:
+        All the image features are kept in one contiguous file with one row per
+        image. The '.ids' file is an append-only log with one line per row,
+        holding the image id and optionally a hash of the image content. The
+        data file is memory-mapped for reading, so a row is a view into the
+        file and nothing is loaded until it is used. An existing store with a
+        different feature shape or data type is discarded, and the rows left
+        behind by re-extracted images are reclaimed when the store is opened.
+        """
+        self.store_path = store_path
+        self.data_path = store_path + '.dat'
+        self.ids_path = store_path + '.ids'
+        self.header_path = store_path + '.json'
+        self.feature_shape = tuple(feature_shape)
+        self.dtype = np.dtype(dtype)
+        self.row_size = int(np.prod(self.feature_shape)) * self.dtype.itemsize
+        self.row_ids = []
+        self.id_to_row = {}
+        self.content_hashes = {}
+        self._array = None
+
+        store_dir = os.path.dirname(store_path)
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+
+        header = {'feature_shape': list(self.feature_shape), 'dtype': self.dtype.str}
+        if os.path.exists(self.header_path):
+            with open(self.header_path, 'r') as file:
+                if json.load(file) != header:
+                    self.remove()
+        if not os.path.exists(self.header_path):
+            with open(self.header_path, 'w') as file:
+                json.dump(header, file)
+
+        self._recover()
+        self.compact()
+
+    def _recover(self):
+        """
+        Loads the id log and drops whatever an interrupted run left half written
+
+        Rows are written to the data file before their ids are logged, so a row
+        without a complete id line, or an id line without a complete row, is
+        dropped and will simply be extracted again. A compaction which wrote
+        its id log is finished, an earlier one is abandoned
+        """
+        compact_ids_path = self.store_path + '.compact.ids'
+        compact_data_path = self.store_path + '.compact.dat'
+        if os.path.exists(compact_ids_path):
+            if os.path.exists(compact_data_path):
+                os.replace(compact_data_path, self.data_path)
+            os.replace(compact_ids_path, self.ids_path)
+        for path in (compact_ids_path + '.tmp', compact_data_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+        if os.path.exists(self.ids_path):
+            with open(self.ids_path, 'rb') as file:
+                content = file.read()
+        else:
+            content = b''
+        lines = content.split(b'\n')[:-1]
+        data_size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        lines = lines[:data_size // self.row_size] if self.row_size else lines
+
+        for line in lines:
+            image_id, _, content_hash = line.decode('utf-8').partition('\t')
+            self.id_to_row[image_id] = len(self.row_ids)
+            self.row_ids.append(image_id)
+            if content_hash:
+                self.content_hashes[image_id] = content_hash
+            else:
+                self.content_hashes.pop(image_id, None)
+
+        with open(self.ids_path, 'ab') as file:
+            file.truncate(sum(len(line) + 1 for line in lines))
+        with open(self.data_path, 'ab') as file:
+            file.truncate(len(self.row_ids) * self.row_size)
+
+    def compact(self, chunk_rows=256):
+        """
+        This function reclaims the rows which no image id points at anymore
+
+        Arguments:
+        - self: FeatureStore class variables
+        - chunk_rows: number of rows copied at once
+
+        Explanation:
+        A re-extracted image is appended and its old row is left dead in the
+        data file. When there are dead rows, the live ones are copied, in
+        store order, to a new data file and a new id log is written. The id
+        log is renamed last, once the data file is complete, so an interrupted
+        compaction is finished or abandoned by _recover. Nothing is done when
+        every row is live. The row of an image changes, rows taken before the
+        compaction must be taken again
+        """
+        if len(self.row_ids) == len(self.id_to_row):
+            return
+        live_rows = np.fromiter(sorted(self.id_to_row.values()), dtype=np.int64, count=len(self.id_to_row))
+        compact_data_path = self.store_path + '.compact.dat'
+        compact_ids_path = self.store_path + '.compact.ids'
+
+        array = self.array
+        with open(compact_data_path, 'wb') as file:
+            for start in range(0, len(live_rows), chunk_rows):
+                file.write(np.ascontiguousarray(array[live_rows[start:start + chunk_rows]]).tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+        row_ids = [self.row_ids[row] for row in live_rows]
+        with open(compact_ids_path + '.tmp', 'wb') as file:
+            file.write(''.join(image_id + ('\t' + self.content_hashes[image_id] if image_id in self.content_hashes else '') + '\n'
+                               for image_id in row_ids).encode('utf-8'))
+            file.flush()
+            os.fsync(file.fileno())
+        del array
+        self._array = None
+        os.replace(compact_ids_path + '.tmp', compact_ids_path)
+
+        os.replace(compact_data_path, self.data_path)
+        os.replace(compact_ids_path, self.ids_path)
+        self.row_ids = row_ids
+        self.id_to_row = {image_id: row for row, image_id in enumerate(row_ids)}
+
+    def remove(self):
+        """
+        This function deletes the files of the store
+        """
+        for path in (self.data_path, self.ids_path, self.header_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.row_ids = []
+        self.id_to_row = {}
+        self.content_hashes = {}
+        self._array = None
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def __len__(self):
+        return len(self.id_to_row)
+
+    def __contains__(self, image_id):
+        return image_id in self.id_to_row
+
+    def missing(self, image_ids):
+        """
+        Returns the image ids which do not have a feature in the store yet
+        """
+        return [image_id for image_id in image_ids if image_id not in self.id_to_row]
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def append(self, image_ids, features, content_hashes=None):
+        """
+        This function appends a batch of features to the store
+
+        Arguments:
+        - self: FeatureStore class variables
+        - image_ids: list of image ids, one per feature
+        - features: array of shape (len(image_ids),) + feature_shape
+        - content_hashes: optional list of image content hashes, one per feature
+
+        Explanation:
+        The features are written to the end of the data file, then their ids
+        are logged. If an image id is already in the store, it is pointed at
+        the newly written row.
+        """
+        features = np.ascontiguousarray(features, dtype=self.dtype)
+        features = features.reshape((len(image_ids),) + self.feature_shape)
+        if content_hashes is None:
+            content_hashes = [''] * len(image_ids)
+
+        with open(self.data_path, 'ab') as file:
+            file.write(features.tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+
+        with open(self.ids_path, 'ab') as file:
+            file.write(''.join(image_id + ('\t' + content_hash if content_hash else '') + '\n'
+                               for image_id, content_hash in zip(image_ids, content_hashes)).encode('utf-8'))
+
+        for image_id, content_hash in zip(image_ids, content_hashes):
+            self.id_to_row[image_id] = len(self.row_ids)
+            self.row_ids.append(image_id)
+            if content_hash:
+                self.content_hashes[image_id] = content_hash
+            else:
+                self.content_hashes.pop(image_id, None)
+        self._array = None
+
+    def flush(self):
+        """
+        This function makes sure the logged ids are on disk
+        """
+        with open(self.ids_path, 'ab') as file:
+            file.flush()
+            os.fsync(file.fileno())
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    @property
+    def array(self):
+        """
+        Memory-mapped view of every row in the store, shape (rows,) + feature_shape
+        """
+        if self._array is None:
+            shape = (len(self.row_ids),) + self.feature_shape
+            if len(self.row_ids) == 0:
+                self._array = np.empty(shape, dtype=self.dtype)
+            else:
+                self._array = np.memmap(self.data_path, dtype=self.dtype, mode='r', shape=shape)
+        return self._array
+
+    def row(self, image_id):
+        return self.id_to_row[image_id]
+
+    def rows(self, image_ids):
+        """
+        Returns the store rows of the given image ids as an int64 array
+        """
+        return np.fromiter((self.id_to_row[image_id] for image_id in image_ids),
+                           dtype=np.int64, count=len(image_ids))
+
+    def get(self, image_id):
+        """
+        Returns the feature of an image as a view into the memory-mapped file
+        """
+        return self.array[self.id_to_row[image_id]]
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+
+class ExtractionCache:
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def __init__(self, cache_dir, backbone_config, feature_shape, dtype='float32', keep=2):
+        """
+        Extraction cache initialization
+
+        Arguments:
+        - self: ExtractionCache class variables
+        - cache_dir: folder of the feature stores
+        - backbone_config: dictionary describing how the features are produced,
+          with at least a 'backbone' name, e.g. the weights, the output layer,
+          the input size and the preprocessing
+        - feature_shape: shape of a single image feature
+        - dtype: numpy data type of the stored features
+        - keep: number of stores of the backbone kept, this one included
+
+        Explanation:
+        The features live in a FeatureStore named after the backbone and a
+        fingerprint of the whole configuration. Each row records the SHA-1 of
+        the image file it was extracted from, so only new or changed images
+        have to be extracted. Opening a cache marks its store as used, and
+        the least recently used stores of the same backbone past keep are
+        deleted, so switching between two configurations, e.g. SHARED_DECODE,
+        extracts nothing again.
+        """
+        self.config = dict(backbone_config)
+        config_text = json.dumps(self.config, sort_keys=True)
+        self.fingerprint = hashlib.sha1(config_text.encode('utf-8')).hexdigest()[:16]
+        name = self.config['backbone']
+        store_path = os.path.join(cache_dir, name + '-' + self.fingerprint)
+
+        self.store = FeatureStore(store_path, feature_shape, dtype)
+        with open(store_path + '.config.json', 'w') as file:
+            file.write(config_text)
+
+        # Other stores of the backbone, most recently used first
+        store_pattern = re.compile(re.escape(name) + r'-[0-9a-f]{16}\.json')
+        stale_paths = [os.path.join(cache_dir, file_name[:-len('.json')]) for file_name in os.listdir(cache_dir)
+                       if store_pattern.fullmatch(file_name)]
+        stale_paths = sorted((path for path in stale_paths if path != store_path), reverse=True,
+                             key=lambda path: os.path.getmtime(path + '.config.json') if os.path.exists(path + '.config.json') else 0)
+        for stale_path in stale_paths[max(0, keep - 1):]:
+            for suffix in ('.dat', '.ids', '.json', '.config.json', '.compact.dat', '.compact.ids'):
+                if os.path.exists(stale_path + suffix):
+                    os.remove(stale_path + suffix)
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def content_hash(self, image_path):
+        digest = hashlib.sha1()
+        with open(image_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def pending(self, image_ids, image_paths, content_hash=None):
+        """
+        This function finds the images which have to be extracted
+
+        Arguments:
+        - self: ExtractionCache class variables
+        - image_ids: list of image ids
+        - image_paths: list of image file paths, one per image id
+        - content_hash: function returning the content hash of an image path,
+          defaults to the SHA-1 of the file, e.g. ZipImageSource.content_hash
+
+        Explanation:
+        Returns the (image_id, image_path, content_hash) of every image which
+        is not in the store yet, or whose content changed since its feature
+        was extracted
+        """
+        content_hash_of = content_hash or self.content_hash
+        pending = []
+        for image_id, image_path in zip(image_ids, image_paths):
+            content_hash = content_hash_of(image_path)
+            if self.store.content_hashes.get(image_id) != content_hash:
+                pending.append((image_id, image_path, content_hash))
+        return pending
+
+    def add(self, image_ids, content_hashes, features):
+        """
+        This function stores a batch of extracted features
+
+        Each batch is logged as soon as it is written, so an interrupted run
+        keeps every completed batch
+        """
+        self.store.append(image_ids, features, content_hashes)
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+
+class ImageCache:
+
+
+    def __init__(self, cache_dir, decoder_config, max_bytes):
+        """
+        Decoded image cache initialization
+
+        Arguments:
+        - self: ImageCache class variables
+        - cache_dir: folder of the image stores, shared by every resolution
+        - decoder_config: dictionary describing how the images are decoded,
+          with at least the 'input_size' (height, width), e.g. the decoder
+          library, the crop and the resize method
+        - max_bytes: budget of all the image stores of cache_dir together
+
+        Explanation:
+        The decoded and resized images are kept as uint8 RGB rows of an
+        ExtractionCache named after their resolution, so extracting features
+        again with another backbone, other weights or another layer skips
+        the JPEG decoding. Every resolution has its own store, a change of the
+        other decoding settings replaces it. Opening a cache marks it as used,
+        and the least recently used stores of other resolutions are deleted
+        until all of them fit max_bytes. The current store then only grows
+        within what is left of the budget, the images past it are decoded
+        every time
+        """
+        height, width = decoder_config['input_size']
+        name = f'images-{height}x{width}'
+        self.cache = ExtractionCache(cache_dir, {'backbone': name, 'channels': 'rgb', **decoder_config},
+                                     (height, width, 3), dtype='uint8', keep=1)
+        self.store = self.cache.store
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.evict()
+
+    def store_paths(self):
+        """
+        Returns the path prefix of every image store of cache_dir, least recently used first
+        """
+        store_pattern = re.compile(r'images-\d+x\d+-[0-9a-f]{16}\.config\.json')
+        paths = [os.path.join(self.cache_dir, file_name[:-len('.config.json')])
+                 for file_name in os.listdir(self.cache_dir) if store_pattern.fullmatch(file_name)]
+        return sorted(paths, key=lambda path: os.path.getmtime(path + '.config.json'))
+
+    def used_bytes(self):
+        return sum(os.path.getsize(path + '.dat') for path in self.store_paths() if os.path.exists(path + '.dat'))
+
+    def evict(self):
+        """
+        This function deletes the least recently used stores of other resolutions
+        until the image stores fit the budget
+        """
+        for path in self.store_paths():
+            if self.used_bytes() <= self.max_bytes:
+                break
+            if path != self.store.store_path:
+                for suffix in ('.dat', '.ids', '.json', '.config.json'):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+
+    def room(self):
+        """
+        Returns the number of images which can still be added within the budget
+        """
+        return max(0, (self.max_bytes - self.used_bytes()) // self.store.row_size)
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def split(self, pending):
+        """
+        This function separates the images which are already decoded
+
+        Arguments:
+        - self: ImageCache class variables
+        - pending: (image_id, image_path, content_hash) of the images to extract
+
+        Explanation:
+        Returns the pending images whose decoded image is in the store with
+        the same content hash, and the ones which have to be decoded
+        """
+        cached, uncached = [], []
+        for image in pending:
+            image_id, _, content_hash = image
+            if self.store.content_hashes.get(image_id) == content_hash:
+                cached.append(image)
+            else:
+                uncached.append(image)
+        return cached, uncached
+
+    def add(self, image_ids, content_hashes, images):
+        """
+        This function stores a batch of decoded uint8 RGB images, as many as
+        fit the budget
+        """
+        count = min(len(image_ids), self.room())
+        if count:
+            self.cache.add(image_ids[:count], content_hashes[:count], np.asarray(images)[:count])
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+
+class FeatureWriter:
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def __init__(self, write, max_pending=4):
+        """
+        Background feature writer
+
+        Arguments:
+        - self: FeatureWriter class variables
+        - write: function called with the arguments of every put, in order,
+          e.g. ExtractionCache.add or FeatureStore.append, whose first argument
+          is the list of image ids of the batch
+        - max_pending: number of batches which can wait to be written, put
+          blocks when the queue is full
+
+        Explanation:
+        A single thread writes the batches, so the rows keep the order they
+        were put in, while the caller goes on extracting the next batch. The
+        bounded queue keeps at most max_pending batches of features in memory.
+        Features can be passed as tensors, their copy to host memory then also
+        happens on the writer thread. An error raised by write is raised again
+        by the next put or by close
+        """
+        self.write = write
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.images_written = 0
+        self.write_time = 0.0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                start = time.perf_counter()
+                self.write(*batch)
+                self.write_time += time.perf_counter() - start
+                self.images_written += len(batch[0])
+            except Exception as error:
+                self.error = error
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def put(self, *batch):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(batch)
+
+    def close(self):
+        """
+        This function waits until every batch is written
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+def benchmark_loading(store, batch_size=64, num_batches=100, seed=0, host_features=None, host_memory_limit=None):
+    """
+    This function measures how fast a tf.data pipeline can load the features of a store
+
+    Arguments:
+    - store: FeatureStore to read from
+    - batch_size: number of features per batch
+    - num_batches: number of batches read by every loading path
+    - seed: seed of the random rows which are read
+    - host_features: host variable already holding the store, e.g. the one
+      training gathers from, which is then reused
+    - host_memory_limit: largest store copied into a host variable for the
+      benchmark, None for no limit
+
+    Explanation:
+    The same random rows are read through three loading paths, with as many
+    parallel calls as tf.data autotunes:
+    - 'per_example': one tf.numpy_function call per row, then batched
+    - 'memmap_batch': one tf.numpy_function call per batch on the memory map
+    - 'host_gather': tf.gather in the graph, over the store held in a host
+      variable, whose copy is not timed. Without host_features, a store
+      larger than host_memory_limit is not copied and the path is None
+    Returns a dictionary with the examples per second of each path
+    """
+    import tensorflow as tf
+
+    autotune = tf.data.experimental.AUTOTUNE
+    rows = np.random.default_rng(seed).integers(0, len(store), batch_size * num_batches)
+    row_dataset = tf.data.Dataset.from_tensor_slices(rows)
+
+    def load_rows(image_rows):
+        return np.asarray(store.array[image_rows], dtype=np.float32)
+
+    if host_features is None and (host_memory_limit is None or store.array.nbytes <= host_memory_limit):
+        with tf.device('/CPU:0'):
+            host_features = tf.Variable(np.asarray(store.array, dtype=np.float32), trainable=False)
+
+    pipelines = {
+        'per_example': row_dataset.map(lambda row: tf.numpy_function(load_rows, [row], tf.float32),
+                                       num_parallel_calls=autotune).batch(batch_size),
+        'memmap_batch': row_dataset.batch(batch_size).map(lambda batch: tf.numpy_function(load_rows, [batch], tf.float32),
+                                                          num_parallel_calls=autotune),
+    }
+    if host_features is not None:
+        pipelines['host_gather'] = row_dataset.batch(batch_size).map(lambda batch: tf.gather(host_features, batch),
+                                                                     num_parallel_calls=autotune)
+
+    throughput = {}
+    for name, dataset in pipelines.items():
+        dataset = dataset.prefetch(autotune)
+        start = time.perf_counter()
+        examples = 0
+        for batch in dataset:
+            examples += int(batch.shape[0])
+        throughput[name] = examples / (time.perf_counter() - start)
+    throughput.setdefault('host_gather', None)
+    return throughput
@@ -190,6 +190,7 @@ print("Images Extracted")
 import tensorflow as tf
 from tqdm import tqdm
 import numpy as np
+from FeatureStore import FeatureStore
 
 def load_image(image_path):
     img = tf.io.read_file(image_path)
@@ -205,20 +206,33 @@ def load_image(image_path):
     return img, image_path
 
 training_image_paths = []
+# Shape of the vector extracted from InceptionV3 is (64, 2048)
+feature_store = FeatureStore("datasets/features/inception_v3", (64, 2048))
+# Kept global so evaluate, generate_caption and caption_batch can use it
+image_features_extract_model = None
+def feature_extractor():
+    # InceptionV3 is only built once an image has to go through it
+    global image_features_extract_model
+    if image_features_extract_model is None:
+        print("Initializing Inception V3 model without the top classification layers")
+        image_model = tf.keras.applications.InceptionV3(include_top=False, weights='imagenet')
+
+        print("Retrieving the input tensor 'new_input' and the output tensor of the last layer 'hidden_layer'")
+        new_input = image_model.input
+        hidden_layer = image_model.layers[-1].output
+
+        print("Creating new model using the created input and output")
+        image_features_extract_model = tf.keras.Model(new_input, hidden_layer)
+    return image_features_extract_model
+
 def process_image_dataset(image_dir, training_image_names):
-    print("Initializing Inception V3 model without the top classification layers")
-    image_model = tf.keras.applications.InceptionV3(include_top=False, weights='imagenet')
-    
-    print("Retrieving the input tensor 'new_input' and the output tensor of the last layer 'hidden_layer'")
-    new_input = image_model.input
-    hidden_layer = image_model.layers[-1].output
-    
-    print("Creating new model using the created input and output")
-    image_features_extract_model = tf.keras.Model(new_input, hidden_layer)
-    
     print("Creating training image path")
-    training_image_paths = [image_dir +'/'+ name + '.jpg' for name in training_image_names]
+    # Images which already have a feature in the store are not extracted again
+    training_image_paths = [image_dir +'/'+ name + '.jpg' for name in feature_store.missing(training_image_names)]
     encode_train = sorted(set(training_image_paths))
+    print("\t", len(encode_train), "of", len(set(training_image_names)), "images have to be extracted")
+    if not encode_train:
+        return
     
     print("Creates a TensorFlow dataset, image_dataset, from the sorted training image paths")
     image_dataset = tf.data.Dataset.from_tensor_slices(encode_train)
@@ -229,17 +243,18 @@ def process_image_dataset(image_dir, training_image_names):
     print("Preparing the preprocessed images in groups of 16 in batches")
     print("Extracting image features on the batch of images")
     print("Reshaping extracted features")
-    print("Saving the features as Numpy file")
+    print("Appending the features to the feature store")
 
     for img, path in tqdm(image_dataset):
           
-          batch_features = image_features_extract_model(img)
+          batch_features = feature_extractor()(img)
          
           batch_features = tf.reshape(batch_features, (batch_features.shape[0], -1, batch_features.shape[3]))
           
-          for bf, p in zip(batch_features, path):
-                path_of_feature = p.numpy().decode("utf-8")
-                np.save(path_of_feature, bf.numpy())
+          image_ids = [os.path.basename(p.decode("utf-8")).split('.')[0] for p in path.numpy()]
+          feature_store.append(image_ids, batch_features.numpy())
+
+    feature_store.flush()
 
 process_image_dataset(image_dir, training_image_names)
 
@@ -322,7 +337,8 @@ def data_prep(data_dict, tokenizer, max_length, vocab_size):
       X, y = list(), list()
       # For each image and list of captions
       for image_name, captions in data_dict.items():
-            image_name = image_dir + image_name + '.jpg'
+            # Row of the image feature in the feature store
+            image_row = feature_store.row(image_name)
             # For each caption in the list of captions
             for caption in captions:
                   # Convert the caption words into a list of word indices
@@ -331,7 +347,7 @@ def data_prep(data_dict, tokenizer, max_length, vocab_size):
                   # Pad the input text to the same fixed length
                   pad_idxs = pad_text(word_idxs, max_length)
                       
-                  X.append(image_name)
+                  X.append(image_row)
                   y.append(pad_idxs)
           
       return array(X), array(y)
@@ -342,18 +358,16 @@ train_X, train_y = data_prep(training_dict, tokenizer, max_caption_words, vocab_
 BATCH_SIZE = 64
 BUFFER_SIZE = 1000
 
-# Load the numpy files
+# Slice the image features out of the memory-mapped feature store
 
-def map_func(img_name, cap):
-      img_name_parts = img_name.split(b"Dataset")
-      img_name = img_name_parts[0] + b"Dataset/" + img_name_parts[1]
-      img_tensor = np.load(img_name.decode('utf-8') + '.npy')
+def map_func(image_row, cap):
+      img_tensor = feature_store.array[image_row]
       return img_tensor, cap
 
 
 dataset = tf.data.Dataset.from_tensor_slices((train_X, train_y))
 
-# Use map to load the numpy files in parallel
+# Use map to load the image features from the feature store in parallel
 dataset = dataset.map(lambda item1, item2: tf.numpy_function(map_func, [item1, item2], [tf.float32, tf.int32]),num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
 # Shuffle and batch
@@ -369,10 +383,19 @@ class BahdanauAttention(tf.keras.Model):
             self.W2 = tf.keras.layers.Dense(units)
             self.V = tf.keras.layers.Dense(1)
 
-      def call(self, features, hidden):
+      def precompute_keys(self, features):
+            # W1(features) does not depend on the decoder state, so it is computed
+            # once per image and reused for every timestep
+            # keys shape == (batch_size, 64, units)
+            return self.W1(features)
+
+      def call(self, features, hidden, keys=None):
+            if keys is None:
+                  keys = self.precompute_keys(features)
+
             hidden_with_time_axis = tf.expand_dims(hidden, 1)
             # attention_hidden_layer shape == (batch_size, 64, units)
-            attention_hidden_layer = (tf.nn.tanh(self.W1(features) +
+            attention_hidden_layer = (tf.nn.tanh(keys +
                                                 self.W2(hidden_with_time_axis)))
             # score shape == (batch_size, 64, 1)
             # This gives you an unnormalized score for each image feature.
@@ -415,9 +438,12 @@ class RNN_Decoder(tf.keras.Model):
 
             self.attention = BahdanauAttention(self.units)
 
-      def call(self, x, features, hidden):
+      def attention_keys(self, features):
+            return self.attention.precompute_keys(features)
+
+      def call(self, x, features, hidden, keys=None):
             # defining attention as a separate model
-            context_vector, attention_weights = self.attention(features, hidden)
+            context_vector, attention_weights = self.attention(features, hidden, keys=keys)
 
             # x shape after passing through embedding == (batch_size, 1, embedding_dim)
             x = self.embedding(x)
@@ -479,9 +505,10 @@ def train_step(img_tensor, target):
 
       with tf.GradientTape() as tape:
         features = encoder(img_tensor)
+        keys = decoder.attention_keys(features)
         for i in range(1, target.shape[1]):
               # passing the features through the decoder
-              predictions, hidden, _ = decoder(dec_input, features, hidden)
+              predictions, hidden, _ = decoder(dec_input, features, hidden, keys)
 
               loss += loss_function(target[:, i], predictions)
 
@@ -525,20 +552,23 @@ def evaluate(image, max_length):
       hidden = decoder.reset_state(batch_size=1)
 
       temp_input = tf.expand_dims(load_image(image)[0], 0)
-      img_tensor_val = image_features_extract_model(temp_input)
+      img_tensor_val = feature_extractor()(temp_input)
       img_tensor_val = tf.reshape(img_tensor_val, (img_tensor_val.shape[0],
                                                       -1,
                                                       img_tensor_val.shape[3]))
 
       features = encoder(img_tensor_val)
 
+      keys = decoder.attention_keys(features)
+
       dec_input = tf.expand_dims([tokenizer.word_index['startseq']], 0)
       result = []
 
       for i in range(max_length):
             predictions, hidden, attention_weights = decoder(dec_input,
                                                             features,
-                                                            hidden)
+                                                            hidden,
+                                                            keys)
 
             attention_plot[i] = tf.reshape(attention_weights, (-1, )).numpy()
 
@@ -583,20 +613,23 @@ def generate_caption(image_path, max_length):
       hidden = decoder.reset_state(batch_size=1)
 
       temp_input = tf.expand_dims(load_image(image_path)[0], 0)
-      img_tensor_val = image_features_extract_model(temp_input)
+      img_tensor_val = feature_extractor()(temp_input)
       img_tensor_val = tf.reshape(img_tensor_val, (img_tensor_val.shape[0],
                                                       -1,
                                                       img_tensor_val.shape[3]))
 
       features = encoder(img_tensor_val)
 
+      keys = decoder.attention_keys(features)
+
       dec_input = tf.expand_dims([tokenizer.word_index['startseq']], 0)
       result = []
 
       for i in range(max_length):
             predictions, hidden, attention_weights = decoder(dec_input,
                                                             features,
-                                                            hidden)
+                                                            hidden,
+                                                            keys)
 
             attention_plot[i] = tf.reshape(attention_weights, (-1, )).numpy()
 
@@ -611,6 +644,66 @@ def generate_caption(image_path, max_length):
       attention_plot = attention_plot[:len(result), :]
       return ' '.join(result[:-1])
 
+#-----------------------------------------------------------
+# Greedy captions for a batch of image paths or RGB arrays, decoded together.
+# Captions which emitted endseq are dropped from the batch as they finish
+#-----------------------------------------------------------
+def caption_batch(images, max_length):
+      start_id = tokenizer.word_index['startseq']
+      end_id = tokenizer.word_index['endseq']
+
+      img = []
+      for image in images:
+            if isinstance(image, (str, bytes)):
+                  img.append(load_image(image)[0])
+            else:
+                  image = tf.image.resize(tf.convert_to_tensor(image), (299, 299))
+                  img.append(tf.keras.applications.inception_v3.preprocess_input(image))
+      img_tensor_val = feature_extractor()(tf.stack(img))
+      img_tensor_val = tf.reshape(img_tensor_val, (img_tensor_val.shape[0],
+                                                      -1,
+                                                      img_tensor_val.shape[3]))
+
+      features = encoder(img_tensor_val)
+      keys = decoder.attention_keys(features)
+      num_images = int(features.shape[0])
+      hidden = decoder.reset_state(batch_size=num_images)
+      dec_input = tf.fill([num_images, 1], start_id)
+
+      # Output row of each caption which is still being decoded
+      active = np.arange(num_images)
+      caption_ids = np.zeros((num_images, max_length), dtype=np.int32)
+
+      for i in range(max_length):
+            predictions, hidden, _ = decoder(dec_input, features, hidden, keys)
+            predicted_ids = tf.argmax(predictions, axis=-1, output_type=tf.int32)
+
+            # A single host copy per step for the whole batch
+            predicted = predicted_ids.numpy()
+            caption_ids[active, i] = predicted
+
+            running = predicted != end_id
+            if not running.all():
+                  active = active[running]
+                  if len(active) == 0:
+                        break
+                  features = tf.boolean_mask(features, running)
+                  keys = tf.boolean_mask(keys, running)
+                  hidden = tf.boolean_mask(hidden, running)
+                  predicted_ids = tf.boolean_mask(predicted_ids, running)
+
+            dec_input = tf.expand_dims(predicted_ids, 1)
+
+      captions = []
+      for ids in caption_ids:
+            words = []
+            for word_id in ids:
+                  if word_id == 0 or word_id == end_id:
+                        break
+                  words.append(tokenizer.index_word[word_id])
+            captions.append(' '.join(words))
+      return captions
+
 # prompt user to enter image path
 image_path = input('Enter path to image file: ')
 
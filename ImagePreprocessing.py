@@ -0,0 +1,369 @@
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+import os
+import time
+import numpy as np
+import tensorflow as tf
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+# libjpeg can decode at 1/1, 1/2, 1/4 or 1/8 of the full resolution by
+# dropping DCT coefficients, which is much cheaper than a full decode
+DCT_RATIOS = (1, 2, 4, 8)
+
+# Resize methods, by tf.image.resize name, with their OpenCV interpolation flag name
+RESIZE_METHODS = {'bilinear': 'INTER_LINEAR',
+                  'area': 'INTER_AREA',
+                  'bicubic': 'INTER_CUBIC',
+                  'nearest': 'INTER_NEAREST',
+                  'lanczos3': 'INTER_LANCZOS4'}
+
+# JPEG start of frame markers, which hold the image size
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def jpeg_size(data):
+    """
+    Returns the (height, width) of a JPEG from its start of frame header,
+    without decoding it, or None if data is not a JPEG
+    """
+    if data[:2] != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        # Fill bytes and markers without a length
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            i += 2
+            continue
+        if marker in SOF_MARKERS:
+            return (int.from_bytes(data[i + 5:i + 7], 'big'), int.from_bytes(data[i + 7:i + 9], 'big'))
+        i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+    return None
+
+
+def dct_ratio(height, width, target_size):
+    """
+    Largest DCT scaling ratio which still decodes at least target_size (height, width)
+    """
+    scale = min(height / target_size[0], width / target_size[1])
+    return max(ratio for ratio in DCT_RATIOS if ratio <= max(scale, 1))
+
+
+def to_uint8_tf(image):
+    """
+    Rounds a float image with values in [0, 255] to uint8
+    """
+    return tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8)
+
+
+def center_crop_window(height, width, target_size):
+    """
+    Returns the [y, x, height, width] of the largest centered window with the
+    aspect ratio of target_size
+    """
+    crop_height = min(height, (width * target_size[0]) // target_size[1])
+    crop_width = min(width, (height * target_size[1]) // target_size[0])
+    return [(height - crop_height) // 2, (width - crop_width) // 2, crop_height, crop_width]
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+class ImageDecoder:
+
+
+    def __init__(self, target_size, dct_scaling=True, crop=None, resize_method='bilinear'):
+        """
+        Image decoding and resizing
+
+        Arguments:
+        - self: ImageDecoder class variables
+        - target_size: (height, width) of the decoded images
+        - dct_scaling: decode JPEGs at 1/2, 1/4 or 1/8 scale when they are
+          at least that much larger than target_size
+        - crop: None to resize the whole image, 'center' to keep the centered
+          window with the aspect ratio of target_size
+        - resize_method: one of RESIZE_METHODS
+
+        Explanation:
+        The JPEG size is read from its header before decoding, so the decode
+        ratio can be picked per image. With TensorFlow the crop is done by
+        the decoder itself, only the blocks of the window are decoded. The
+        decoded image is then resized to target_size with resize_method
+        """
+        if resize_method not in RESIZE_METHODS:
+            raise ValueError(f"Unknown resize method '{resize_method}', expected one of {sorted(RESIZE_METHODS)}")
+        if crop not in (None, 'center'):
+            raise ValueError(f"Unknown crop '{crop}', expected None or 'center'")
+        self.target_size = tuple(target_size)
+        self.dct_scaling = dct_scaling
+        self.crop = crop
+        self.resize_method = resize_method
+
+    @classmethod
+    def from_env(cls, target_size):
+        """
+        Returns the ImageDecoder of target_size set up by the environment
+
+        JPEG_DCT_SCALING=0 decodes the JPEGs at full size, IMAGE_CROP=center
+        crops them to a square, IMAGE_RESIZE_METHOD picks the resize kernel,
+        e.g. area. Every script reads them here, so the decoded images, and
+        their cache fingerprints, match between the scripts
+        """
+        return cls(target_size,
+                   dct_scaling=os.environ.get('JPEG_DCT_SCALING', '1') == '1',
+                   crop=os.environ.get('IMAGE_CROP') or None,
+                   resize_method=os.environ.get('IMAGE_RESIZE_METHOD', 'bilinear'))
+
+    def config(self):
+        """
+        Settings which change the decoded images, for the feature cache fingerprint
+        """
+        return {'input_size': list(self.target_size),
+                'dct_scaling': self.dct_scaling,
+                'crop': self.crop,
+                'resize': self.resize_method}
+
+    def shared_config(self, target_size):
+        """
+        Settings of the target_size images of decode_sizes_tf, which are
+        decoded for this decoder's target_size and resized from there
+        """
+        return {**self.config(),
+                'decoder': 'tf',
+                'decoded_for': list(self.target_size),
+                'input_size': list(target_size)}
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def decode_tf(self, contents):
+        """
+        This function decodes and resizes an encoded image with TensorFlow ops
+
+        Arguments:
+        - self: ImageDecoder class variables
+        - contents: scalar string tensor, e.g. from tf.io.read_file
+
+        Explanation:
+        Returns a float32 (height, width, 3) tensor with values in [0, 255],
+        like tf.image.resize of tf.image.decode_jpeg
+        """
+        return self.decode_sizes_tf(contents, [self.target_size])[0]
+
+    def decode_sizes_tf(self, contents, target_sizes):
+        """
+        This function decodes an encoded image once and resizes it to several sizes
+
+        Arguments:
+        - self: ImageDecoder class variables
+        - contents: scalar string tensor, e.g. from tf.io.read_file
+        - target_sizes: list of (height, width)
+
+        Explanation:
+        Returns one float32 image per target size, see decode_tf. The DCT
+        ratio and the crop are chosen for this decoder's target_size, which
+        should be the largest, and every size is resized from that image
+        """
+        decoded = self.decode_scaled_tf(contents)
+        return [tf.cast(tf.image.resize(decoded, target_size, method=self.resize_method), tf.float32)
+                for target_size in target_sizes]
+
+    def decode_scaled_tf(self, contents):
+        """
+        This function decodes and crops an encoded image, before resizing
+
+        Explanation:
+        Returns the uint8 (height, width, 3) image. decode_jpeg only takes its
+        ratio as a constant, so tf.switch_case picks the branch of the ratio
+        computed from the JPEG header. Other image formats are decoded at
+        full size
+        """
+        target_size = self.target_size
+
+        def decode(ratio):
+            def branch():
+                if ratio == 1 and self.crop is None:
+                    return tf.io.decode_image(contents, channels=3, expand_animations=False)
+                shape = tf.image.extract_jpeg_shape(contents)
+                # Size of the image decoded at this ratio
+                height = (shape[0] + ratio - 1) // ratio
+                width = (shape[1] + ratio - 1) // ratio
+                if self.crop is None:
+                    return tf.image.decode_jpeg(contents, channels=3, ratio=ratio)
+                # The crop window is given in the coordinates of the scaled image
+                crop_height = tf.minimum(height, (width * target_size[0]) // target_size[1])
+                crop_width = tf.minimum(width, (height * target_size[1]) // target_size[0])
+                window = tf.stack([(height - crop_height) // 2, (width - crop_width) // 2, crop_height, crop_width])
+                return tf.image.decode_and_crop_jpeg(contents, window, channels=3, ratio=ratio)
+            return branch
+
+        is_jpeg = tf.equal(tf.strings.substr(contents, 0, 2), b'\xff\xd8')
+        if self.dct_scaling or self.crop is not None:
+            if self.dct_scaling:
+                shape = tf.cond(is_jpeg, lambda: tf.image.extract_jpeg_shape(contents),
+                                lambda: tf.constant([0, 0, 3], tf.int32))
+                scale = tf.minimum(shape[0] / target_size[0], shape[1] / target_size[1])
+                # Index of the largest ratio which is not above the scale
+                ratio_index = tf.reduce_sum(tf.cast(tf.constant(DCT_RATIOS[1:], tf.float64) <= scale, tf.int32))
+            else:
+                ratio_index = tf.constant(0)
+            ratio_index = tf.where(is_jpeg, ratio_index, -1)
+            img = tf.switch_case(ratio_index, [decode(ratio) for ratio in DCT_RATIOS],
+                                 default=lambda: self.crop_tf(tf.io.decode_image(contents, channels=3,
+                                                                                 expand_animations=False)))
+        else:
+            img = tf.io.decode_image(contents, channels=3, expand_animations=False)
+        img.set_shape([None, None, 3])
+        return img
+
+    def crop_tf(self, image):
+        """
+        This function crops an already decoded (height, width, 3) image
+        """
+        if self.crop != 'center':
+            return image
+        shape = tf.shape(image)
+        crop_height = tf.minimum(shape[0], (shape[1] * self.target_size[0]) // self.target_size[1])
+        crop_width = tf.minimum(shape[1], (shape[0] * self.target_size[1]) // self.target_size[0])
+        return tf.image.crop_to_bounding_box(image, (shape[0] - crop_height) // 2, (shape[1] - crop_width) // 2,
+                                             crop_height, crop_width)
+
+    def resize_tf(self, image):
+        """
+        This function crops and resizes an already decoded (height, width, 3) image
+        """
+        image = self.crop_tf(tf.convert_to_tensor(image))
+        return tf.cast(tf.image.resize(image, self.target_size, method=self.resize_method), tf.float32)
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def read_cv2(self, file_path):
+        """
+        This function reads and resizes an image with OpenCV
+
+        Arguments:
+        - self: ImageDecoder class variables
+        - file_path: path of the image file
+
+        Explanation:
+        Returns the uint8 BGR image resized to target_size, or None if the
+        image couldn't be loaded. For JPEGs, the size is read from the header
+        and IMREAD_REDUCED_COLOR_2/4/8 decodes at the chosen ratio. OpenCV
+        has no crop during decode, so the crop is done after decoding.
+        OpenCV releases the GIL while decoding, so this can run in worker threads
+        """
+        try:
+            with open(file_path, 'rb') as file:
+                data = file.read()
+        except OSError:
+            return None
+        return self.decode_cv2(data)
+
+    def decode_cv2(self, data):
+        """
+        Same as read_cv2, on the bytes of an encoded image
+        """
+        import cv2
+
+        flag = cv2.IMREAD_COLOR
+        size = jpeg_size(data) if self.dct_scaling else None
+        if size is not None:
+            height, width = size
+            if self.crop == 'center':
+                _, _, height, width = center_crop_window(height, width, self.target_size)
+            ratio = dct_ratio(height, width, self.target_size)
+            if ratio > 1:
+                flag = getattr(cv2, f'IMREAD_REDUCED_COLOR_{ratio}')
+
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+        if img is None:
+            return None
+        if self.crop == 'center':
+            y, x, height, width = center_crop_window(img.shape[0], img.shape[1], self.target_size)
+            img = img[y:y + height, x:x + width]
+        interpolation = getattr(cv2, RESIZE_METHODS[self.resize_method])
+        # cv2.resize takes the size as (width, height)
+        return cv2.resize(img, (self.target_size[1], self.target_size[0]), interpolation=interpolation)
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+def benchmark_decode(image_paths, target_size, resize_method='bilinear', repeat=1, read=None):
+    """
+    This function measures the decode cost of images, per source megapixel
+
+    Arguments:
+    - image_paths: list of image files to decode
+    - target_size: (height, width) the images are resized to
+    - resize_method: one of RESIZE_METHODS
+    - repeat: number of times every image is decoded
+    - read: function returning the encoded image of a path, e.g. the read
+      of an image source, defaults to reading the file
+
+    Explanation:
+    The images are read into memory first, so only decoding and resizing
+    are timed. Full and DCT-scaled decoding are measured with TensorFlow,
+    and with OpenCV when it is installed. Returns a dictionary with the
+    milliseconds per source megapixel of each path
+    """
+    contents = []
+    megapixels = 0.0
+    for image_path in image_paths:
+        if read is not None:
+            data = read(image_path)
+        else:
+            with open(image_path, 'rb') as file:
+                data = file.read()
+        size = jpeg_size(data)
+        if size is None:
+            continue
+        contents.append(data)
+        megapixels += size[0] * size[1] / 1e6
+    megapixels *= repeat
+
+    decoders = {'full': ImageDecoder(target_size, dct_scaling=False, resize_method=resize_method),
+                'dct_scaled': ImageDecoder(target_size, dct_scaling=True, resize_method=resize_method)}
+
+    cost = {}
+    for name, decoder in decoders.items():
+        decode = tf.function(decoder.decode_tf, input_signature=[tf.TensorSpec([], tf.string)])
+        decode(tf.constant(contents[0]))
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for data in contents:
+                decode(tf.constant(data))
+        cost['tf_' + name] = (time.perf_counter() - start) * 1000 / megapixels
+
+    try:
+        import cv2
+    except ImportError:
+        return cost
+
+    interpolation = getattr(cv2, RESIZE_METHODS[resize_method])
+    for name, dct_scaling in (('full', False), ('dct_scaled', True)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for data in contents:
+                flag = cv2.IMREAD_COLOR
+                if dct_scaling:
+                    ratio = dct_ratio(*jpeg_size(data), target_size)
+                    if ratio > 1:
+                        flag = getattr(cv2, f'IMREAD_REDUCED_COLOR_{ratio}')
+                img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+                cv2.resize(img, (target_size[1], target_size[0]), interpolation=interpolation)
+        cost['cv2_' + name] = (time.perf_counter() - start) * 1000 / megapixels
+    return cost
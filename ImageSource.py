@@ -0,0 +1,226 @@
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+import os
+import zlib
+import hashlib
+import struct
+import zipfile
+import threading
+import numpy as np
+import tensorflow as tf
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def image_id_of(name):
+    """
+    Image id of a file or member name, its base name without extension
+    """
+    return os.path.basename(name).split('.')[0]
+
+
+def open_image_source(path):
+    """
+    Returns a ZipImageSource for a '.zip' file, a DirectoryImageSource otherwise
+    """
+    if path.endswith('.zip') and os.path.isfile(path):
+        return ZipImageSource(path)
+    return DirectoryImageSource(path)
+
+
+def default_image_source(image_dir="datasets/Flicker8k_Dataset", zip_file_path="datasets/download_image_file.zip"):
+    """
+    Returns the image source of IMAGE_SOURCE, a folder or a zip file. Without
+    it, the extracted folder when there is one, the images are read straight
+    from the zip file otherwise
+    """
+    return open_image_source(os.environ.get('IMAGE_SOURCE', image_dir if os.path.isdir(image_dir) else zip_file_path))
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+class DirectoryImageSource:
+
+
+    def __init__(self, folder_path):
+        """
+        Images stored as files in a folder
+
+        Arguments:
+        - self: DirectoryImageSource class variables
+        - folder_path: folder of the image files
+
+        Explanation:
+        Every image source maps image ids to names, the file paths here,
+        and reads the encoded image of a name, from Python with read or
+        inside a tf.data pipeline with read_tf. The content hash is the
+        SHA-1 of the file, like ExtractionCache.content_hash, so it has to
+        read every image but a changed one is never missed
+        """
+        self.folder_path = folder_path
+        self.names = {image_id_of(file): os.path.join(folder_path, file)
+                      for file in sorted(os.listdir(folder_path)) if file.lower().endswith(IMAGE_EXTENSIONS)}
+
+    def __contains__(self, image_id):
+        return image_id in self.names
+
+    def image_ids(self):
+        return sorted(self.names)
+
+    def name(self, image_id):
+        return self.names[image_id]
+
+    def read(self, name):
+        with open(name, 'rb') as file:
+            return file.read()
+
+    def read_tf(self, name):
+        return tf.io.read_file(name)
+
+    def size(self, name):
+        return os.path.getsize(name)
+
+    def content_hash(self, name):
+        digest = hashlib.sha1()
+        with open(name, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+class ZipImageSource:
+
+
+    def __init__(self, zip_file_path):
+        """
+        Images read straight from a zip file, without extracting it
+
+        Arguments:
+        - self: ZipImageSource class variables
+        - zip_file_path: path of the zip file
+
+        Explanation:
+        The central directory is read once into an index from member name
+        to its entry. A member is then read by seeking to its local header
+        and inflating only its own data, so images are read in any order.
+        Every thread keeps its own file handle, so the worker threads of
+        tf.data or of a thread pool read in parallel, zlib and the file
+        reads release the GIL, close closes all of them. Member names are
+        the names, and the content hash comes from the CRC-32 and size stored
+        in the central directory, so no image has to be read to find the
+        changed ones. A CRC-32 is weaker than the SHA-1 of
+        DirectoryImageSource, and the two hashes differ, so moving the
+        images between the folder and the zip file extracts them again
+        """
+        self.zip_file_path = zip_file_path
+        with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+            infos = zip_ref.infolist()
+        self.entries = {}
+        self.names = {}
+        for info in infos:
+            base_name = os.path.basename(info.filename)
+            # Skip folders and the '__MACOSX/._<name>' resource forks
+            if info.is_dir() or base_name.startswith('.') or info.filename.startswith('__MACOSX/'):
+                continue
+            if base_name.lower().endswith(IMAGE_EXTENSIONS):
+                self.entries[info.filename] = info
+                self.names[image_id_of(base_name)] = info.filename
+        self.local = threading.local()
+        # File handles of all the threads, closed together by close
+        self.files = []
+        self.files_lock = threading.Lock()
+
+    def __contains__(self, image_id):
+        return image_id in self.names
+
+    def image_ids(self):
+        return sorted(self.names)
+
+    def name(self, image_id):
+        return self.names[image_id]
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def read(self, name):
+        """
+        This function reads and inflates a single member of the zip file
+        """
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
+        info = self.entries[name]
+        file = getattr(self.local, 'file', None)
+        if file is None or file.closed:
+            file = self.local.file = open(self.zip_file_path, 'rb')
+            with self.files_lock:
+                self.files.append(file)
+
+        file.seek(info.header_offset)
+        header = file.read(30)
+        if header[:4] != b'PK\x03\x04':
+            raise zipfile.BadZipFile(f"Bad local header for member '{name}'")
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        file.seek(info.header_offset + 30 + name_length + extra_length)
+        data = file.read(info.compress_size)
+
+        if info.compress_type == zipfile.ZIP_STORED:
+            content = data
+        elif info.compress_type == zipfile.ZIP_DEFLATED:
+            content = zlib.decompress(data, -15)
+        else:
+            with zipfile.ZipFile(self.zip_file_path, 'r') as zip_ref:
+                return zip_ref.read(name)
+        if zlib.crc32(content) != info.CRC:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for member '{name}'")
+        return content
+
+    def read_tf(self, name):
+        def read(member):
+            # member is bytes inside tf.data, a 0-d array when run eagerly
+            if isinstance(member, np.ndarray):
+                member = member.item()
+            return np.array(self.read(member), dtype=object)
+        content = tf.numpy_function(read, [name], tf.string)
+        return tf.reshape(content, [])
+
+    def size(self, name):
+        return self.entries[name].file_size
+
+    def content_hash(self, name):
+        info = self.entries[name]
+        return f'crc32:{info.CRC:08x}:{info.file_size}'
+
+    def close(self):
+        """
+        This function closes the file handles of every thread once the images
+        are read, a later read opens a new one
+        """
+        with self.files_lock:
+            files, self.files = self.files, []
+        for file in files:
+            file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,278 @@
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+import os
+import json
+import heapq
+import shutil
+import hashlib
+import numpy as np
+import tensorflow as tf
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+# Version of the layout of the shard files and of their index
+SHARD_FORMAT = 1
+
+# Target size of a shard, large enough for sequential reads to dominate
+SHARD_SIZE = 128 << 20
+
+INDEX_FILE = 'index.json'
+
+
+def shard_file_name(shard, num_shards):
+    return f'shard-{shard:05d}-of-{num_shards:05d}.tfrecord'
+
+
+def balance_shards(sizes, num_shards):
+    """
+    Returns the shard of every record, so that the shards have about the same size
+
+    The largest records are placed first, each on the currently smallest shard
+    """
+    shard_of = np.zeros(len(sizes), dtype=np.int32)
+    heap = [(0, shard) for shard in range(num_shards)]
+    for record in np.argsort(-np.asarray(sizes), kind='stable'):
+        size, shard = heapq.heappop(heap)
+        shard_of[record] = shard
+        heapq.heappush(heap, (size + int(sizes[record]), shard))
+    return shard_of
+
+
+def _bytes_feature(values):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=values))
+
+
+def _int64_feature(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+def pack_shards(shard_dir, image_ids, image_index, tokens, lengths=None, words=None, store=None, image_source=None,
+                shard_size=SHARD_SIZE, min_shards=8):
+    """
+    This function packs images and their encoded captions into TFRecord shards
+
+    Arguments:
+    - shard_dir: folder of the shards and of their index
+    - image_ids: image names, image_index refers to them
+    - image_index: row of the caption's image in image_ids, one per caption
+    - tokens: int32 matrix with one post-padded row of word ids per caption
+    - lengths: number of word ids in each row, defaults to the non-zero ids
+    - words: vocabulary of the word ids, kept in the index
+    - store: FeatureStore the extracted features are packed from
+    - image_source: image source the encoded images are packed from, when
+      there is no store
+    - shard_size: target size of a shard in bytes
+    - min_shards: least number of shards, so that reads can be interleaved
+
+    Explanation:
+    Every image with at least one caption becomes one tf.train.Example with
+    its id, its feature or encoded image, and the word ids of all its
+    captions. The records are spread over the shards so that every shard
+    holds about the same number of bytes, and are written in feature store
+    order, so the store is read sequentially. The index lists the shards with
+    their image ids, record and byte counts, and a fingerprint of everything
+    packed, including the content hash of every image. When the existing
+    index has the same fingerprint nothing is written. Otherwise the shards
+    are written to a temporary folder which then replaces shard_dir.
+    Returns the ShardReader of shard_dir
+    """
+    if (store is None) == (image_source is None):
+        raise ValueError("Exactly one of store and image_source must be given")
+    tokens = np.asarray(tokens, dtype=np.int32)
+    image_index = np.asarray(image_index, dtype=np.int64)
+    if lengths is None:
+        lengths = np.count_nonzero(tokens, axis=1)
+    lengths = np.asarray(lengths, dtype=np.int64)
+
+    # Captions of every packed image, in caption order
+    packed = np.unique(image_index)
+    order = np.argsort(image_index, kind='stable')
+    starts = np.searchsorted(image_index[order], packed)
+    ends = np.append(starts[1:], len(order))
+    packed_ids = [image_ids[i] for i in packed]
+
+    if store is not None:
+        payload = 'features'
+        content_hashes = [store.content_hashes.get(image_id, '') for image_id in packed_ids]
+        payload_sizes = np.full(len(packed), store.row_size, dtype=np.int64)
+    else:
+        payload = 'image'
+        names = [image_source.name(image_id) for image_id in packed_ids]
+        content_hashes = [image_source.content_hash(name) for name in names]
+        payload_sizes = np.array([image_source.size(name) for name in names], dtype=np.int64)
+
+    key = {'format': SHARD_FORMAT,
+           'payload': payload,
+           'feature_shape': list(store.feature_shape) if store is not None else None,
+           'dtype': store.dtype.str if store is not None else None,
+           'images': hashlib.sha1('\n'.join(f'{image_id}\t{content_hash}' for image_id, content_hash
+                                            in zip(packed_ids, content_hashes)).encode('utf-8')).hexdigest(),
+           'captions': hashlib.sha1(b''.join(np.ascontiguousarray(array).tobytes() for array
+                                             in (tokens, lengths, image_index))).hexdigest(),
+           'words': hashlib.sha1('\n'.join(words or []).encode('utf-8')).hexdigest(),
+           'shard_size': shard_size,
+           'min_shards': min_shards}
+    fingerprint = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    index_path = os.path.join(shard_dir, INDEX_FILE)
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as file:
+            if json.load(file).get('fingerprint') == fingerprint:
+                return ShardReader(shard_dir)
+
+    # Word ids are stored as int64, a few bytes each once varint encoded
+    sizes = payload_sizes + (ends - starts) * 4 + np.array([lengths[order[start:end]].sum() * 2 for start, end
+                                                              in zip(starts, ends)], dtype=np.int64)
+    num_shards = int(min(len(packed), max(min_shards, -(-int(sizes.sum()) // shard_size))))
+    shard_of = balance_shards(sizes, num_shards)
+
+    tmp_dir = shard_dir.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    shards = []
+    for shard in range(num_shards):
+        records = np.flatnonzero(shard_of == shard)
+        if store is not None:
+            # Sequential reads of the memory map
+            records = records[np.argsort(store.rows([packed_ids[r] for r in records]), kind='stable')]
+        file_name = shard_file_name(shard, num_shards)
+        with tf.io.TFRecordWriter(os.path.join(tmp_dir, file_name)) as writer:
+            for record in records:
+                image_id = packed_ids[record]
+                captions = order[starts[record]:ends[record]]
+                caption_lengths = lengths[captions]
+                caption_tokens = np.concatenate([tokens[caption, :length] for caption, length
+                                                 in zip(captions, caption_lengths)])
+                if store is not None:
+                    data = np.ascontiguousarray(store.get(image_id)).tobytes()
+                else:
+                    data = image_source.read(names[record])
+                example = tf.train.Example(features=tf.train.Features(feature={
+                    'image_id': _bytes_feature([image_id.encode('utf-8')]),
+                    payload: _bytes_feature([data]),
+                    'tokens': _int64_feature(caption_tokens),
+                    'lengths': _int64_feature(caption_lengths)}))
+                writer.write(example.SerializeToString())
+        shards.append({'file': file_name,
+                       'records': len(records),
+                       'captions': int(sum(ends[r] - starts[r] for r in records)),
+                       'bytes': os.path.getsize(os.path.join(tmp_dir, file_name)),
+                       'image_ids': [packed_ids[r] for r in records]})
+
+    index = {'format': SHARD_FORMAT,
+             'fingerprint': fingerprint,
+             'payload': payload,
+             'feature_shape': key['feature_shape'],
+             'dtype': key['dtype'],
+             'max_length': int(tokens.shape[1]),
+             'max_captions': int((ends - starts).max()),
+             'words': list(words or []),
+             'shards': shards}
+    with open(os.path.join(tmp_dir, INDEX_FILE), 'w') as file:
+        json.dump(index, file)
+
+    if os.path.exists(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.replace(tmp_dir, shard_dir)
+    return ShardReader(shard_dir)
+
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+class ShardReader:
+
+
+    def __init__(self, shard_dir):
+        """
+        Reader of the shards written by pack_shards
+
+        Arguments:
+        - self: ShardReader class variables
+        - shard_dir: folder of the shards and of their index
+
+        Explanation:
+        The index is loaded once. dataset reads several shards at the same
+        time, each one sequentially, and parses the records in parallel, so
+        training never opens the individual image files
+        """
+        with open(os.path.join(shard_dir, INDEX_FILE), 'r') as file:
+            self.index = json.load(file)
+        if self.index.get('format') != SHARD_FORMAT:
+            raise ValueError(f"Shards in '{shard_dir}' have format {self.index.get('format')}, expected {SHARD_FORMAT}")
+        self.shard_dir = shard_dir
+        self.payload = self.index['payload']
+        self.feature_shape = tuple(self.index['feature_shape']) if self.index['feature_shape'] else None
+        self.dtype = np.dtype(self.index['dtype']) if self.index['dtype'] else None
+        self.max_length = self.index['max_length']
+        # Most captions of a single image
+        self.max_captions = self.index['max_captions']
+        self.words = self.index['words']
+        self.files = [os.path.join(shard_dir, shard['file']) for shard in self.index['shards']]
+
+    def __len__(self):
+        return sum(shard['records'] for shard in self.index['shards'])
+
+    def num_captions(self):
+        return sum(shard['captions'] for shard in self.index['shards'])
+
+    def nbytes(self):
+        return sum(shard['bytes'] for shard in self.index['shards'])
+
+#-----------------------------------------------------------------
+#-----------------------------------------------------------------
+
+    def parse(self, record):
+        """
+        This function parses one record into (image_id, features or encoded image, captions)
+
+        The captions are a (captions, max_length) int32 matrix, post-padded
+        with zeros like the packed tokens
+        """
+        parsed = tf.io.parse_single_example(record, {
+            'image_id': tf.io.FixedLenFeature([], tf.string),
+            self.payload: tf.io.FixedLenFeature([], tf.string),
+            'tokens': tf.io.VarLenFeature(tf.int64),
+            'lengths': tf.io.VarLenFeature(tf.int64)})
+        captions = tf.RaggedTensor.from_row_lengths(tf.sparse.to_dense(parsed['tokens']),
+                                                    tf.sparse.to_dense(parsed['lengths']))
+        captions = tf.cast(captions.to_tensor(shape=[None, self.max_length]), tf.int32)
+        data = parsed[self.payload]
+        if self.payload == 'features':
+            data = tf.reshape(tf.io.decode_raw(data, tf.as_dtype(self.dtype)), self.feature_shape)
+        return parsed['image_id'], data, captions
+
+    def dataset(self, shuffle=False, cycle_length=None, block_length=1, seed=None):
+        """
+        This function provides the records of all the shards
+
+        Arguments:
+        - self: ShardReader class variables
+        - shuffle: shuffle the shard order, and let the interleaved shards
+          deliver their records as soon as they are read
+        - cycle_length: number of shards read at the same time, defaults to
+          the CPU count
+        - block_length: number of consecutive records taken from a shard
+        - seed: seed of the shard shuffle
+
+        Explanation:
+        Returns a dataset of (image_id, data, captions), see parse. Without
+        shuffle the order is the same on every pass
+        """
+        files = tf.data.Dataset.from_tensor_slices(self.files)
+        if shuffle:
+            files = files.shuffle(len(self.files), seed=seed)
+        cycle_length = min(len(self.files), cycle_length or os.cpu_count())
+        dataset = files.interleave(lambda file: tf.data.TFRecordDataset(file, buffer_size=8 << 20),
+                                   cycle_length=cycle_length, block_length=block_length,
+                                   num_parallel_calls=tf.data.experimental.AUTOTUNE, deterministic=not shuffle)
+        return dataset.map(self.parse, num_parallel_calls=tf.data.experimental.AUTOTUNE, deterministic=not shuffle)